@@ -1,6 +1,4 @@
 import io
-import os
-import requests
 import logging
 from typing import Optional
 from PyPDF2 import PdfReader
@@ -8,44 +6,6 @@ from PyPDF2 import PdfReader
 # Глобальный словарь ожидания паролей для пользователей
 awaiting_pdf_passwords = {}
 
-YANDEX_DISK_API = "https://cloud-api.yandex.net/v1/disk/resources"
-
-def list_knowledge_base() -> list[str]:
-    token = os.getenv("YANDEX_TOKEN")
-    base_path = os.getenv("YANDEX_KB_PATH", "disk:/База Знаний")
-
-    logging.info(f"[KB] Используемый путь: {base_path}")
-
-    if not token:
-        logging.error("YANDEX_TOKEN отсутствует в переменных окружения")
-        return []
-
-    headers = {"Authorization": f"OAuth {token}"}
-    all_files = []
-
-    def list_recursive(path):
-        try:
-            response = requests.get(
-                YANDEX_DISK_API,
-                headers=headers,
-                params={"path": path, "limit": 1000}
-            )
-            response.raise_for_status()
-            data = response.json()
-            items = data.get("_embedded", {}).get("items", [])
-
-            for item in items:
-                if item["type"] == "file":
-                    all_files.append(item["path"].replace(base_path + "/", ""))
-                elif item["type"] == "dir":
-                    list_recursive(item["path"])
-        except Exception as e:
-            logging.exception(f"[KB] Ошибка при обходе {path}: {e}")
-
-    list_recursive(base_path)
-    logging.info(f"[KB] Найдено {len(all_files)} файлов в базе знаний по пути: {base_path}")
-    return all_files
-
 def extract_text(fileobj: io.BytesIO, filename: str) -> str:
     filename = filename.lower()
 
@@ -0,0 +1,114 @@
+"""
+Скорость нарезки на чанки: прежний split_text (encoding_for_model и decode на каждый чанк)
+против iter_chunks по одному документу — так режет переиндексация (страницы документа
+токенизируются пачками, чанки — срезы по смещениям токенов) — и chunk_texts, который
+токенизирует несколько документов одним encode_ordinary_batch (split_text, kb_bench).
+
+    python -m bot.knowledge_base.chunk_bench --dir data/corpus
+    python -m bot.knowledge_base.chunk_bench --synthetic 2000
+    python -m bot.knowledge_base.chunk_bench --synthetic 20 --words 300000   # большие одностраничные файлы
+
+Текстовые файлы (.txt, .md, .csv, .json, .html) из --dir читаются как корпус;
+без --dir генерируется синтетический корпус из --synthetic документов.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from typing import Dict, List
+
+import tiktoken
+
+from .splitter import byte_encoder, chunk_texts, get_encoder, iter_chunks, warm_up
+
+TEXT_EXTS = (".txt", ".md", ".csv", ".json", ".html")
+
+
+def legacy_split_text(text: str, max_tokens: int = 500, overlap: int = 50, model: str = "gpt-4o-mini",
+                      enc: tiktoken.Encoding = None) -> List[str]:
+    """Прежний алгоритм (с исправленным выходом из цикла) для сравнения; enc — токенизатор офлайн-прогона."""
+    enc = enc or tiktoken.encoding_for_model(model)
+    tokens = enc.encode(text)
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        chunks.append(enc.decode(tokens[start:end]))
+        if end == len(tokens):
+            break
+        start = end - overlap
+    return chunks
+
+
+def load_corpus(directory: str) -> List[str]:
+    texts = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(TEXT_EXTS):
+                with open(os.path.join(root, name), "r", encoding="utf-8", errors="ignore") as f:
+                    texts.append(f.read())
+    return texts
+
+
+def synthetic_corpus(docs: int, words: int = 3000, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    vocab = ("договор поставка счёт оплата срок ответственность сторона акт SKU-10442 error E-503 "
+             "contract invoice delivery payment clause party warranty 2024 №17/3 г. Москва").split()
+    return [" ".join(rng.choice(vocab) for _ in range(words)) for _ in range(docs)]
+
+
+def _row(name: str, chunks: int, size: int, seconds: float) -> Dict:
+    return {
+        "method": name,
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "chunks_per_s": round(chunks / seconds, 1) if seconds else None,
+        "mb_per_s": round(size / seconds / 1e6, 2) if seconds else None,
+    }
+
+
+def benchmark(texts: List[str], max_tokens: int = 500, overlap: int = 50, model: str = "gpt-4o-mini",
+              batch: int = 256) -> List[Dict]:
+    size = sum(len(t.encode("utf-8")) for t in texts)
+    warm_up([model])
+    # без файлов BPE get_encoder считает байты — тем же токенизатором режет и прежний алгоритм
+    offline = byte_encoder() if get_encoder(model) is byte_encoder() else None
+
+    t0 = time.perf_counter()
+    legacy = sum(len(legacy_split_text(t, max_tokens, overlap, model, offline)) for t in texts)
+    rows = [_row("split_text (legacy)", legacy, size, time.perf_counter() - t0)]
+
+    t0 = time.perf_counter()
+    chunks = sum(sum(1 for _ in iter_chunks([(1, t)], max_tokens, overlap, model)) for t in texts)
+    rows.append(_row("iter_chunks (per document, reindex)", chunks, size, time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    chunks = 0
+    for i in range(0, len(texts), batch):
+        chunks += sum(len(c) for c in chunk_texts(texts[i:i + batch], max_tokens, overlap, model))
+    rows.append(_row("chunk_texts (batched)", chunks, size, time.perf_counter() - t0))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir")
+    parser.add_argument("--synthetic", type=int, default=2000)
+    parser.add_argument("--words", type=int, default=3000, help="слов в синтетическом документе")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--max-tokens", type=int, default=500)
+    parser.add_argument("--overlap", type=int, default=50)
+    args = parser.parse_args()
+
+    texts = load_corpus(args.dir) if args.dir else synthetic_corpus(args.synthetic, args.words)
+    if not texts:
+        raise SystemExit(f"No text files in {args.dir}")
+    print(f"{len(texts)} documents, {sum(len(t) for t in texts) / 1e6:.1f}M chars, "
+          f"max_tokens={args.max_tokens}, overlap={args.overlap}, encoding={get_encoder(args.model).name}")
+    for r in benchmark(texts, args.max_tokens, args.overlap, args.model):
+        print(json.dumps(r, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import tempfile
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, Tuple
+
+import httpx
+
+from .yandex_client import RemoteFile, YandexDiskClient
+
+# Ответы, на которых имеет смысл повторить запрос
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# файлы крупнее держим во временном файле, а не в памяти, пока идёт скачивание
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+
+async def download_with_retries(yd: YandexDiskClient, remote_path: str, timeout: float = 120.0,
+                                retries: int = 3, backoff: float = 1.0) -> bytes:
+    """Скачивание во временный файл; повторная попытка докачивает остаток через Range."""
+    attempt = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as spool:
+        while True:
+            try:
+                await yd.adownload_to(remote_path, spool, timeout=timeout)
+                spool.seek(0)
+                return spool.read()
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRY_STATUSES or attempt >= retries:
+                    raise
+            except httpx.TransportError:
+                if attempt >= retries:
+                    raise
+            attempt += 1
+            delay = backoff * 2 ** (attempt - 1)
+            logging.warning("[KB] retry %d/%d for %s from byte %d in %.1fs",
+                            attempt, retries, remote_path, spool.tell(), delay)
+            await asyncio.sleep(delay)
+
+
+async def iter_fetched(fetch: Callable[[RemoteFile], Awaitable[bytes]], files: Iterable[RemoteFile],
+                       concurrency: int = 4) -> AsyncIterator[Tuple[RemoteFile, Optional[bytes], Optional[Exception]]]:
+    """
+    Получает содержимое файлов через fetch параллельно (не более concurrency одновременно)
+    и отдаёт (file, content, error) в порядке готовности, чтобы разбор начинался сразу.
+    """
+    pending = iter(files)
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    done = object()
+
+    async def worker():
+        for rf in pending:
+            try:
+                content = await fetch(rf)
+                await results.put((rf, content, None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await results.put((rf, None, e))
+        await results.put(done)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        finished = 0
+        while finished < len(workers):
+            item = await results.get()
+            if item is done:
+                finished += 1
+                continue
+            yield item
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+def iter_downloads(yd: YandexDiskClient, files: Iterable[RemoteFile], concurrency: int = 4,
+                   timeout: float = 120.0, retries: int = 3, backoff: float = 1.0
+                   ) -> AsyncIterator[Tuple[RemoteFile, Optional[bytes], Optional[Exception]]]:
+    """Параллельное скачивание с Я.Диска с повторами (см. iter_fetched)."""
+    return iter_fetched(lambda rf: download_with_retries(yd, rf.path, timeout, retries, backoff), files, concurrency)
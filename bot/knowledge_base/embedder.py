@@ -1,10 +1,198 @@
-from openai import OpenAI
+import asyncio
+import logging
+import time
+from typing import List, Optional, Protocol, Tuple
+
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+from .splitter import get_encoder
+
+# Лимиты embeddings API: на один вход и на один запрос
+MAX_INPUT_TOKENS = 8191
+MAX_REQUEST_TOKENS = 300_000
+MAX_REQUEST_INPUTS = 2048
+
+
+def _is_too_large(e: Exception) -> bool:
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 413:
+            return True
+        if e.status_code == 400 and "token" in str(e).lower():
+            return True
+    return False
+
+
+class TextEmbedder(Protocol):
+    """
+    Что нужно индексации и поиску от бэкенда эмбеддингов: Embedder (OpenAI),
+    LocalEmbedder (офлайн), CachedEmbedder поверх любого из них.
+    """
+    model: str
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        ...
+
+    async def aembed(self, texts: List[str], urgent: bool = False) -> List[List[float]]:
+        ...
+
 
 class Embedder:
-    def __init__(self, api_key: str, model: str = "text-embedding-3-large"):
+    """
+    Эмбеддинги OpenAI с упаковкой входов в батчи по числу токенов.
+    aembed() объединяет запросы от одновременных вызовов (например, разных файлов
+    при индексации), держит до concurrency батчей в полёте и уменьшает размер
+    батча при 429/413. Порядок результатов совпадает с порядком входов.
+    Соседние вызовы ждутся до linger секунд; aembed(urgent=True) отправляет накопленное
+    сразу — для запросов пользователя, которые уже собрал QueryBatcher.
+    """
+    def __init__(self, api_key: str, model: str = "text-embedding-3-large", batch_tokens: int = 100_000,
+                 concurrency: int = 4, max_retries: int = 5, linger: float = 0.05):
         self.client = OpenAI(api_key=api_key)
+        self.aclient = AsyncOpenAI(api_key=api_key)
         self.model = model
+        self.batch_tokens = min(batch_tokens, MAX_REQUEST_TOKENS)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.linger = linger
+        self.enc = get_encoder(model)
+        self._pending: List[Tuple[List[str], List[int], asyncio.Future]] = []
+        self._pending_tokens = 0
+        self._flusher: Optional[asyncio.Task] = None
+        self._full = None
+        self._slots = None
+
+    # ------------------------------------------------------------------
+    # Подготовка входов
+    # ------------------------------------------------------------------
+    def _prepare(self, texts: List[str]) -> Tuple[List[str], List[int]]:
+        prepared, counts = [], []
+        for t in texts:
+            tokens = self.enc.encode_ordinary(t or " ")
+            if len(tokens) > MAX_INPUT_TOKENS:
+                tokens = tokens[:MAX_INPUT_TOKENS]
+                t = self.enc.decode(tokens)
+            prepared.append(t or " ")
+            counts.append(len(tokens))
+        return prepared, counts
+
+    def _plan(self, counts: List[int], start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Режет диапазон входов на батчи, не превышающие self.batch_tokens."""
+        end = len(counts) if end is None else end
+        batches = []
+        batch_start, batch_tokens = start, 0
+        for i in range(start, end):
+            if i > batch_start and (batch_tokens + counts[i] > self.batch_tokens
+                                    or i - batch_start >= MAX_REQUEST_INPUTS):
+                batches.append((batch_start, i))
+                batch_start, batch_tokens = i, 0
+            batch_tokens += counts[i]
+        if batch_start < end:
+            batches.append((batch_start, end))
+        return batches
+
+    def _shrink(self, counts: List[int], start: int, end: int) -> List[Tuple[int, int]]:
+        """Уменьшает лимит батча и заново режет отклонённый батч."""
+        self.batch_tokens = max(MAX_INPUT_TOKENS, min(self.batch_tokens, sum(counts[start:end]) // 2))
+        logging.warning("[KB] embeddings batch limit reduced to %d tokens", self.batch_tokens)
+        plan = self._plan(counts, start, end)
+        if len(plan) == 1 and end - start > 1:
+            mid = (start + end) // 2
+            plan = [(start, mid), (mid, end)]
+        return plan
+
+    # ------------------------------------------------------------------
+    # Синхронный путь
+    # ------------------------------------------------------------------
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        prepared, counts = self._prepare(texts)
+        out: List[Optional[List[float]]] = [None] * len(prepared)
+        queue = self._plan(counts)
+        attempt = 0
+        while queue:
+            start, end = queue.pop(0)
+            try:
+                resp = self.client.embeddings.create(model=self.model, input=prepared[start:end])
+            except openai.RateLimitError:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                queue = self._shrink(counts, start, end) + queue
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            except openai.APIStatusError as e:
+                if not _is_too_large(e) or end - start == 1:
+                    raise
+                queue = self._shrink(counts, start, end) + queue
+                continue
+            attempt = 0
+            for d in resp.data:
+                out[start + d.index] = d.embedding
+        return out
+
+    # ------------------------------------------------------------------
+    # Асинхронный путь
+    # ------------------------------------------------------------------
+    async def aembed(self, texts: List[str], urgent: bool = False) -> List[List[float]]:
+        if not texts:
+            return []
+        prepared, counts = self._prepare(texts)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((prepared, counts, future))
+        self._pending_tokens += sum(counts)
+        if self._flusher is None or self._flusher.done():
+            self._full = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush())
+        if urgent or self._pending_tokens >= self.batch_tokens:
+            self._full.set()
+        return await future
+
+    async def _flush(self):
+        # ждём немного, чтобы собрать входы от соседних вызовов в общие батчи
+        try:
+            await asyncio.wait_for(self._full.wait(), timeout=self.linger)
+        except asyncio.TimeoutError:
+            pass
+        pending, self._pending, self._pending_tokens = self._pending, [], 0
+        self._flusher = None
+
+        texts, counts, owners = [], [], []
+        for prepared, c, future in pending:
+            owners.append((future, len(texts), len(prepared)))
+            texts.extend(prepared)
+            counts.extend(c)
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        try:
+            await asyncio.gather(*(self._run_batch(texts, counts, s, e, out) for s, e in self._plan(counts)))
+        except Exception as e:
+            for future, _, _ in owners:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, offset, n in owners:
+            if not future.done():
+                future.set_result(out[offset:offset + n])
 
-    def embed(self, texts: list[str]) -> list[list[float]]:
-        resp = self.client.embeddings.create(model=self.model, input=texts)
-        return [d.embedding for d in resp.data]
+    async def _run_batch(self, texts: List[str], counts: List[int], start: int, end: int, out: list, attempt: int = 0):
+        try:
+            async with self._slots:
+                resp = await self.aclient.embeddings.create(model=self.model, input=texts[start:end])
+        except openai.RateLimitError:
+            if attempt >= self.max_retries:
+                raise
+            plan = self._shrink(counts, start, end)
+            await asyncio.sleep(min(2 ** (attempt + 1), 30))
+            await asyncio.gather(*(self._run_batch(texts, counts, s, e, out, attempt + 1) for s, e in plan))
+            return
+        except openai.APIStatusError as e:
+            if not _is_too_large(e) or end - start == 1:
+                raise
+            plan = self._shrink(counts, start, end)
+            await asyncio.gather(*(self._run_batch(texts, counts, s, e, out, attempt) for s, e in plan))
+            return
+        for d in resp.data:
+            out[start + d.index] = d.embedding
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    Персистентный кэш эмбеддингов: (model, sha256(text)) -> float32 вектор в SQLite.
+    Размер ограничен max_bytes, при превышении вытесняются давно не использованные.
+    Исходные векторы остаются на диске, поэтому индекс можно перестроить
+    (например, сменить тип FAISS) без повторных запросов к API.
+    """
+    def __init__(self, path: str = "data/embeddings.sqlite", max_bytes: int = 2 * 1024 ** 3):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, key BLOB NOT NULL, vector BLOB NOT NULL, used REAL NOT NULL,"
+            " PRIMARY KEY (model, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings(used)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, keys: List[bytes]) -> Dict[bytes, List[float]]:
+        found: Dict[bytes, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique), 500):
+                part = unique[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(part))})",
+                    [model, *part],
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+            if found:
+                now = time.time()
+                self._db.executemany("UPDATE embeddings SET used = ? WHERE model = ? AND key = ?",
+                                     [(now, model, k) for k in found])
+                self._db.commit()
+        self.hits += sum(1 for k in keys if k in found)
+        self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, model: str, items: Dict[bytes, List[float]]):
+        if not items:
+            return
+        now = time.time()
+        rows = [(model, k, np.asarray(v, dtype=np.float32).tobytes(), now) for k, v in items.items()]
+        with self._lock:
+            for _, k, _, _ in rows:
+                old = self._db.execute("SELECT LENGTH(vector) FROM embeddings WHERE model = ? AND key = ?",
+                                       (model, k)).fetchone()
+                if old:
+                    self._size -= old[0]
+            self._db.executemany("INSERT OR REPLACE INTO embeddings(model, key, vector, used) VALUES (?, ?, ?, ?)", rows)
+            self._size += sum(len(r[2]) for r in rows)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY used LIMIT 1000").fetchall()
+            if not rows:
+                break
+            freed, victims = 0, []
+            for rowid, size in rows:
+                victims.append((rowid,))
+                freed += size
+                if self._size - freed <= self.max_bytes * 0.9:
+                    break
+            self._db.executemany("DELETE FROM embeddings WHERE rowid = ?", victims)
+            self._size -= freed
+
+    def iter_vectors(self, model: str, batch: int = 10000):
+        """Все сохранённые векторы модели пачками (np.ndarray)."""
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT rowid, vector FROM embeddings WHERE model = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (model, last, batch)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class CachedEmbedder:
+    """Обёртка над Embedder: в API уходят только тексты, которых ещё нет в кэше."""
+    def __init__(self, embedder, cache: EmbeddingCache):
+        self.embedder = embedder
+        self.cache = cache
+
+    @property
+    def model(self) -> str:
+        return self.embedder.model
+
+    def _split(self, texts: List[str]):
+        keys = [text_key(t) for t in texts]
+        found = self.cache.get_many(self.model, keys)
+        # одинаковые тексты (шаблонные колонтитулы и т.п.) отправляем один раз
+        missing: Dict[bytes, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in missing:
+                missing[k] = t
+        return keys, found, missing
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        keys, found, missing = self._split(texts)
+        if missing:
+            vectors = self.embedder.embed(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model, fresh)
+            found.update(fresh)
+        return [found[k] for k in keys]
+
+    async def aembed(self, texts: List[str], urgent: bool = False) -> List[List[float]]:
+        if not texts:
+            return []
+        keys, found, missing = await asyncio.to_thread(self._split, texts)
+        if missing:
+            vectors = await self.embedder.aembed(list(missing.values()), urgent=urgent)
+            fresh = dict(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self.cache.put_many, self.model, fresh)
+            found.update(fresh)
+        return [found[k] for k in keys]
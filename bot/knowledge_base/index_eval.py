@@ -0,0 +1,164 @@
+"""
+Отчёт recall@k / задержка для типов индекса VectorStore относительно точного поиска.
+
+    python -m bot.knowledge_base.index_eval --cache data/embeddings.sqlite --model text-embedding-3-large
+    python -m bot.knowledge_base.index_eval --types= --quantizations fp16,int8 --truncate 1024,512 --rescore 4
+
+Векторы берутся из EmbeddingCache, поэтому сравнение не требует запросов к API.
+"""
+import argparse
+import json
+import time
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from .vector_store import COMPONENT_BYTES, build_index, truncate_vectors
+
+
+def _recall(truth: np.ndarray, found: np.ndarray) -> float:
+    k = truth.shape[1]
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / (len(truth) * k)
+
+
+def _timed_search(index: faiss.Index, queries: np.ndarray, k: int):
+    latencies = []
+    found = np.empty((len(queries), k), dtype="int64")
+    for i, q in enumerate(queries):
+        t0 = time.perf_counter()
+        _, I = index.search(q[None, :], k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        found[i] = I[0]
+    return found, latencies
+
+
+def _row(kind: str, param: str, truth: np.ndarray, found: np.ndarray, latencies: List[float], build_s: float,
+         bytes_per_vector: Optional[int] = None) -> Dict:
+    row = {
+        "index_type": kind,
+        "param": param,
+        "recall": round(_recall(truth, found), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "build_s": round(build_s, 2),
+    }
+    if bytes_per_vector is not None:
+        row["bytes_per_vector"] = bytes_per_vector
+    return row
+
+
+def _rescored(candidates: np.ndarray, vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Точное переранжирование кандидатов по исходным векторам (как VectorStore с rescore)."""
+    out = np.empty((len(queries), k), dtype="int64")
+    for row, (q, cand) in enumerate(zip(queries, candidates)):
+        cand = cand[cand >= 0]
+        dist = ((vectors[cand] - q) ** 2).sum(axis=1)
+        out[row, :min(k, len(cand))] = cand[np.argsort(dist)[:k]]
+    return out
+
+
+def evaluate_compression(vectors: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int = 10,
+                         quantizations=("fp16", "int8"), truncate_dims=(), rescore: int = 0) -> List[Dict]:
+    """
+    Плоский индекс со скалярным квантованием и/или усечением размерности против точного
+    поиска на полных векторах; при rescore > 0 — ещё и с точным пересчётом k * rescore кандидатов.
+    """
+    dim = vectors.shape[1]
+    ids = np.arange(len(vectors), dtype="int64")
+    rows = []
+    for tdim in (dim,) + tuple(d for d in truncate_dims if d < dim):
+        for quant in ("none",) + tuple(quantizations):
+            if tdim == dim and quant == "none":
+                continue  # это и есть точный поиск
+            base, q = truncate_vectors(vectors, tdim), truncate_vectors(queries, tdim)
+            t0 = time.perf_counter()
+            index = build_index("flat", tdim, base, quantization=quant)
+            index.add_with_ids(base, ids)
+            build_s = time.perf_counter() - t0
+            param = f"{quant} dim={tdim}"
+            found, latencies = _timed_search(index, q, k)
+            rows.append(_row("flat", param, truth, found, latencies, build_s, COMPONENT_BYTES[quant] * tdim))
+            if rescore:
+                candidates, latencies = _timed_search(index, q, k * rescore)
+                found = _rescored(candidates, vectors, queries, k)
+                rows.append(_row("flat", f"{param} rescore={rescore}", truth, found, latencies, build_s,
+                                 COMPONENT_BYTES[quant] * tdim))
+    return rows
+
+
+def _exact(vectors: np.ndarray) -> faiss.Index:
+    index = build_index("flat", vectors.shape[1])
+    index.add_with_ids(vectors, np.arange(len(vectors), dtype="int64"))
+    return index
+
+
+def evaluate(vectors: np.ndarray, queries: np.ndarray, k: int = 10, index_types=("hnsw", "ivf_flat", "ivf_pq"),
+             nprobes=(1, 4, 16, 64), ef_searches=(16, 64, 256), nlist: Optional[int] = None) -> List[Dict]:
+    """Строит каждый тип индекса на vectors и сравнивает выдачу с IndexFlatL2."""
+    dim = vectors.shape[1]
+    ids = np.arange(len(vectors), dtype="int64")
+
+    t0 = time.perf_counter()
+    flat = build_index("flat", dim)
+    flat.add_with_ids(vectors, ids)
+    build_s = time.perf_counter() - t0
+    truth, latencies = _timed_search(flat, queries, k)
+    rows = [_row("flat", "-", truth, truth, latencies, build_s)]
+
+    for kind in index_types:
+        t0 = time.perf_counter()
+        index = build_index(kind, dim, vectors, nlist=nlist)
+        index.add_with_ids(vectors, ids)
+        build_s = time.perf_counter() - t0
+        if kind == "hnsw":
+            hnsw = faiss.downcast_index(index.index).hnsw
+            for ef in ef_searches:
+                hnsw.efSearch = ef
+                found, latencies = _timed_search(index, queries, k)
+                rows.append(_row(kind, f"efSearch={ef}", truth, found, latencies, build_s))
+        else:
+            ivf = faiss.extract_index_ivf(index)
+            for nprobe in nprobes:
+                ivf.nprobe = nprobe
+                found, latencies = _timed_search(index, queries, k)
+                rows.append(_row(kind, f"nprobe={nprobe}", truth, found, latencies, build_s))
+    return rows
+
+
+def main():
+    from .embedding_cache import EmbeddingCache
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cache", default="data/embeddings.sqlite")
+    parser.add_argument("--model", default="text-embedding-3-large")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--types", default="hnsw,ivf_flat,ivf_pq")
+    parser.add_argument("--quantizations", default="", help="например fp16,int8")
+    parser.add_argument("--truncate", default="", help="усечённые размерности, например 1024,512")
+    parser.add_argument("--rescore", type=int, default=0, help="кандидатов на k для точного пересчёта")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.cache)
+    parts = list(cache.iter_vectors(args.model))
+    if not parts:
+        raise SystemExit(f"No cached vectors for {args.model} in {args.cache}")
+    vectors = np.concatenate(parts)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    rows = evaluate(vectors, queries, k=args.k, index_types=tuple(t for t in args.types.split(",") if t))
+    quantizations = tuple(q for q in args.quantizations.split(",") if q)
+    truncate_dims = tuple(int(d) for d in args.truncate.split(",") if d)
+    if quantizations or truncate_dims:
+        truth, _ = _timed_search(_exact(vectors), queries, args.k)
+        rows += evaluate_compression(vectors, queries, truth, k=args.k, quantizations=quantizations,
+                                     truncate_dims=truncate_dims, rescore=args.rescore)
+    print(f"{len(vectors)} vectors, dim={vectors.shape[1]}, {len(queries)} queries, k={args.k}")
+    for r in rows:
+        print(json.dumps(r))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,478 @@
+"""
+Бенчмарк конвейера базы знаний на синтетическом корпусе: загрузчики всех форматов
+EXT_LOADERS, split_text, эмбеддинги (LocalEmbedder вместо API), VectorStore.add/search
+и Retriever.search.
+
+    python -m bot.knowledge_base.kb_bench --docs 20 --words 2000 --out bench.json
+    python -m bot.knowledge_base.kb_bench --index-type hnsw --quantization int8 --compare bench.json
+
+Отчёт: документов и чанков в секунду по этапам, пиковый RSS процесса после каждого
+этапа, p50/p95/p99 задержки запросов и recall@k VectorStore относительно точного
+поиска по тем же векторам. С --out результаты пишутся в JSON (вместе с коммитом
+и параметрами), --compare печатает изменения метрик относительно прошлого прогона.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import faiss
+import numpy as np
+
+from .index_eval import _exact, _recall
+from .loaders import EXT_LOADERS, load_document
+from .local_embedder import LocalEmbedder
+from .retriever import Retriever
+from .splitter import split_text, warm_up
+from .vector_store import VectorStore
+
+PARAGRAPH_WORDS = 60
+PDF_LINE_CHARS = 90
+PDF_PAGE_LINES = 60
+SLIDE_PARAGRAPHS = 3
+
+
+# ----------------------------------------------------------------------
+# Синтетический корпус
+# ----------------------------------------------------------------------
+def _vocabulary(rng: random.Random, size: int = 3000) -> List[str]:
+    base = ("договор поставка счёт оплата срок ответственность сторона акт SKU-10442 error E-503 "
+            "contract invoice delivery payment clause party warranty 2024 №17/3 г. Москва").split()
+    # псевдослова из слогов одной письменности: кириллица и латиница (последняя попадает и в PDF)
+    scripts = ("ка ро ми на те ло вер пос ста ни ко ра ду ль".split(),
+               "ex con ta ri on mel tor ad in ver pro dis sa lu".split())
+    words = set()
+    while len(words) < size:
+        syllables = rng.choice(scripts)
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return base + sorted(words)
+
+
+def synthetic_paragraphs(rng: random.Random, vocab: List[str], words: int) -> List[str]:
+    # частоты слов по Ципфу, как в естественном тексте: у чанков есть и общие, и редкие слова
+    weights = [1.0 / (rank + 1) for rank in range(len(vocab))]
+    paragraphs = []
+    for start in range(0, words, PARAGRAPH_WORDS):
+        n = min(PARAGRAPH_WORDS, words - start)
+        paragraphs.append(" ".join(rng.choices(vocab, weights, k=n)) + ".")
+    return paragraphs
+
+
+def _zip(parts: Dict[str, str]) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, xml in parts.items():
+            z.writestr(name, xml)
+    return buf.getvalue()
+
+
+_XML = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+
+def make_pdf(paragraphs: List[str]) -> bytes:
+    """Минимальный PDF со шрифтом Helvetica; базовые шрифты — только латиница, кириллица опускается."""
+    lines = []
+    for p in paragraphs:
+        line = ""
+        for word in (w for w in p.split() if w.isascii()):
+            if line and len(line) + len(word) + 1 > PDF_LINE_CHARS:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}" if line else word
+        lines.extend((line, ""))
+    pages = [lines[i:i + PDF_PAGE_LINES] for i in range(0, len(lines), PDF_PAGE_LINES)] or [[]]
+
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", "", "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in pages:
+        text = "".join("({}) Tj T* ".format(l.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)"))
+                       for l in page)
+        stream = f"BT /F1 10 Tf 12 TL 40 800 Td {text}ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for no, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{no} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def make_docx(paragraphs: List[str]) -> bytes:
+    body = "".join(f"<w:p><w:r><w:t>{escape(p)}</w:t></w:r></w:p>" for p in paragraphs)
+    return _zip({
+        "[Content_Types].xml": _XML + (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>'),
+        "_rels/.rels": _XML + (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{_REL}/officeDocument" Target="word/document.xml"/></Relationships>'),
+        "word/document.xml": _XML + (
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>"),
+    })
+
+
+def make_pptx(paragraphs: List[str]) -> bytes:
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    prs = Presentation()
+    for i in range(0, len(paragraphs), SLIDE_PARAGRAPHS):
+        slide = prs.slides.add_slide(prs.slide_layouts[6])  # пустой макет
+        box = slide.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(6.5))
+        box.text_frame.text = "\n".join(paragraphs[i:i + SLIDE_PARAGRAPHS])
+    buf = io.BytesIO()
+    prs.save(buf)
+    return buf.getvalue()
+
+
+def make_xlsx(paragraphs: List[str]) -> bytes:
+    """Минимальная книга OOXML с одним листом (id, text); строки — inline, без sharedStrings."""
+    rows = ['<row r="1"><c r="A1" t="inlineStr"><is><t>id</t></is></c>'
+            '<c r="B1" t="inlineStr"><is><t>text</t></is></c></row>']
+    for no, p in enumerate(paragraphs, start=2):
+        rows.append(f'<row r="{no}"><c r="A{no}"><v>{no - 1}</v></c>'
+                    f'<c r="B{no}" t="inlineStr"><is><t>{escape(p)}</t></is></c></row>')
+    ct = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+    return _zip({
+        "[Content_Types].xml": _XML + (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            f'<Override PartName="/xl/workbook.xml" ContentType="{ct}.sheet.main+xml"/>'
+            f'<Override PartName="/xl/worksheets/sheet1.xml" ContentType="{ct}.worksheet+xml"/></Types>'),
+        "_rels/.rels": _XML + (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{_REL}/officeDocument" Target="xl/workbook.xml"/></Relationships>'),
+        "xl/workbook.xml": _XML + (
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            f'xmlns:r="{_REL}"><sheets><sheet name="data" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+        "xl/_rels/workbook.xml.rels": _XML + (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{_REL}/worksheet" Target="worksheets/sheet1.xml"/></Relationships>'),
+        "xl/worksheets/sheet1.xml": _XML + (
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            f"<sheetData>{''.join(rows)}</sheetData></worksheet>"),
+    })
+
+
+def make_csv(paragraphs: List[str]) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["id", "text"])
+    writer.writerows(enumerate(paragraphs, start=1))
+    return buf.getvalue().encode("utf-8")
+
+
+def make_json(paragraphs: List[str]) -> bytes:
+    items = [{"id": no, "text": p} for no, p in enumerate(paragraphs, start=1)]
+    return json.dumps(items, ensure_ascii=False).encode("utf-8")
+
+
+def make_txt(paragraphs: List[str]) -> bytes:
+    return "\n\n".join(paragraphs).encode("utf-8")
+
+
+def make_md(paragraphs: List[str]) -> bytes:
+    parts = ["# Документ"]
+    for no, p in enumerate(paragraphs, start=1):
+        parts.append(f"## Раздел {no}\n\n{p}")
+    return "\n\n".join(parts).encode("utf-8")
+
+
+def make_html(paragraphs: List[str]) -> bytes:
+    body = "".join(f"<h2>Раздел {no}</h2><p>{escape(p)}</p>" for no, p in enumerate(paragraphs, start=1))
+    return f"<html><head><title>Документ</title></head><body>{body}</body></html>".encode("utf-8")
+
+
+MAKERS = {
+    ".pdf": make_pdf,
+    ".docx": make_docx,
+    ".pptx": make_pptx,
+    ".xlsx": make_xlsx,
+    ".csv": make_csv,
+    ".json": make_json,
+    ".txt": make_txt,
+    ".md": make_md,
+    ".html": make_html,
+}
+
+
+def synthetic_corpus(docs: int, words: int = 2000, formats=tuple(EXT_LOADERS), seed: int = 0) -> List[Tuple[str, bytes]]:
+    """docs документов по words слов в каждом из форматов: [(имя файла, содержимое)]."""
+    missing = set(formats) - set(MAKERS)
+    if missing:
+        raise ValueError(f"No generator for: {', '.join(sorted(missing))}")
+    rng = random.Random(seed)
+    vocab = _vocabulary(rng)
+    corpus = []
+    for ext in formats:
+        for no in range(docs):
+            corpus.append((f"doc{no:05d}{ext}", MAKERS[ext](synthetic_paragraphs(rng, vocab, words))))
+    return corpus
+
+
+# ----------------------------------------------------------------------
+# Измерения
+# ----------------------------------------------------------------------
+def peak_rss_mb() -> Optional[float]:
+    """Пиковый RSS процесса с момента запуска (монотонно растёт); None, где нет resource."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+def _rate(n: int, seconds: float) -> Optional[float]:
+    return round(n / seconds, 1) if seconds else None
+
+
+def _latency(latencies: List[float]) -> Dict:
+    return {f"p{p}_ms": round(float(np.percentile(latencies, p)), 3) for p in (50, 95, 99)}
+
+
+def _stage(name: str, seconds: float, **fields) -> Dict:
+    return {"stage": name, "seconds": round(seconds, 3), **fields, "peak_rss_mb": peak_rss_mb()}
+
+
+def bench_load(corpus: List[Tuple[str, bytes]]) -> Tuple[List[Dict], List[Tuple[str, str]]]:
+    """Загрузчики по форматам; ошибки (например, нет openpyxl для .xlsx) считаются, но не прерывают прогон."""
+    by_ext: Dict[str, List[Tuple[str, bytes]]] = {}
+    for name, content in corpus:
+        by_ext.setdefault(os.path.splitext(name)[1], []).append((name, content))
+    rows, texts = [], []
+    for ext, docs in by_ext.items():
+        errors, error = 0, None
+        t0 = time.perf_counter()
+        for name, content in docs:
+            try:
+                texts.append((name, load_document(name, content)))
+            except Exception as e:
+                errors += 1
+                error = f"{type(e).__name__}: {e}"
+        seconds = time.perf_counter() - t0
+        size = sum(len(c) for _, c in docs)
+        row = _stage(f"load {ext}", seconds, docs=len(docs) - errors, docs_per_s=_rate(len(docs) - errors, seconds),
+                     mb_per_s=round(size / seconds / 1e6, 2) if seconds else None)
+        if errors:
+            row.update(errors=errors, error=error[:200])
+        rows.append(row)
+    return rows, texts
+
+
+def bench_split(texts: List[Tuple[str, str]], max_tokens: int, overlap: int, model: str) -> Tuple[Dict, List[Tuple]]:
+    warm_up([model])  # загрузка токенизатора не входит в замер
+    meta = []
+    t0 = time.perf_counter()
+    for name, text in texts:
+        meta.extend((name, no, chunk) for no, chunk in enumerate(split_text(text, max_tokens, overlap, model)))
+    seconds = time.perf_counter() - t0
+    return _stage("split_text", seconds, docs=len(texts), chunks=len(meta), docs_per_s=_rate(len(texts), seconds),
+                  chunks_per_s=_rate(len(meta), seconds)), meta
+
+
+def bench_embed(embedder: LocalEmbedder, chunks: List[str], batch: int) -> Tuple[Dict, np.ndarray]:
+    t0 = time.perf_counter()
+    vectors = []
+    for i in range(0, len(chunks), batch):
+        vectors.extend(embedder.embed(chunks[i:i + batch]))
+    seconds = time.perf_counter() - t0
+    return (_stage("embed", seconds, model=embedder.model, chunks=len(chunks), chunks_per_s=_rate(len(chunks), seconds)),
+            np.asarray(vectors, dtype="float32").reshape(-1, embedder.dim))
+
+
+def bench_add(store: VectorStore, vectors: np.ndarray, meta: List[Tuple], batch: int) -> Dict:
+    t0 = time.perf_counter()
+    for i in range(0, len(meta), batch):
+        store.add(vectors[i:i + batch], meta[i:i + batch])
+    seconds = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    store.save()
+    return _stage("vector_store.add", seconds, chunks=len(meta), chunks_per_s=_rate(len(meta), seconds),
+                  save_s=round(time.perf_counter() - t0, 3), index=store.kind, quantization=store.sq,
+                  **store.memory_stats())
+
+
+def bench_search(store: VectorStore, vectors: np.ndarray, queries: np.ndarray, k: int) -> Dict:
+    found = np.full((len(queries), k), -1, dtype="int64")
+    latencies = []
+    for row, q in enumerate(queries):
+        t0 = time.perf_counter()
+        hits = store.search_ids(q.tolist(), k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        found[row, :len(hits)] = [i for i, _ in hits]
+    # id в свежем хранилище совпадают с номерами векторов, поэтому эталон — плоский индекс по ним же
+    _, truth = _exact(vectors).search(queries, k)
+    return _stage("vector_store.search", sum(latencies) / 1000, queries=len(queries), k=k,
+                  **_latency(latencies), **{f"recall@{k}": round(_recall(truth, found), 4)})
+
+
+def bench_retriever(retriever: Retriever, queries: List[str], k: int, mode: str) -> Dict:
+    latencies = []
+    for q in queries:
+        # кэши выдачи и эмбеддингов сбрасываем: меряем полный путь запроса
+        retriever.query_cache.clear()
+        retriever.result_cache.clear()
+        t0 = time.perf_counter()
+        retriever.search(q, top_k=k, mode=mode)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return _stage("retriever.search", sum(latencies) / 1000, mode=mode, queries=len(queries), k=k,
+                  **_latency(latencies))
+
+
+def sample_queries(chunks: List[str], n: int, words: int = 8, seed: int = 0) -> List[str]:
+    """Запросы — случайные отрывки из чанков, чтобы у каждого был релевантный ответ."""
+    rng = random.Random(seed)
+    queries = []
+    for chunk in rng.sample(chunks, min(n, len(chunks))):
+        tokens = chunk.split()
+        start = rng.randrange(max(1, len(tokens) - words))
+        queries.append(" ".join(tokens[start:start + words]))
+    return queries
+
+
+def _commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run(docs: int = 20, words: int = 2000, formats=tuple(EXT_LOADERS), k: int = 10, queries: int = 200,
+        mode: str = "hybrid", dim: int = 512, max_tokens: int = 500, overlap: int = 50, model: str = "gpt-4o-mini",
+        batch: int = 256, index_type: str = "flat", quantization: str = "none", truncate_dim: Optional[int] = None,
+        rescore: int = 0, seed: int = 0) -> Dict:
+    config = dict(locals())
+    config["formats"] = list(formats)
+    result = {
+        "commit": _commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "faiss": getattr(faiss, "__version__", None),
+        "platform": platform.platform(),
+        "config": config,
+        "stages": [],
+    }
+    stages = result["stages"]
+
+    t0 = time.perf_counter()
+    corpus = synthetic_corpus(docs, words, formats, seed)
+    stages.append(_stage("generate", time.perf_counter() - t0, docs=len(corpus),
+                         mb=round(sum(len(c) for _, c in corpus) / 1e6, 2)))
+
+    rows, texts = bench_load(corpus)
+    stages.extend(rows)
+    del corpus
+    row, meta = bench_split(texts, max_tokens, overlap, model)
+    stages.append(row)
+    if not meta:
+        return result
+    del texts
+
+    embedder = LocalEmbedder(dim=dim, seed=seed)
+    chunks = [m[2] for m in meta]
+    row, vectors = bench_embed(embedder, chunks, batch)
+    stages.append(row)
+
+    with tempfile.TemporaryDirectory(prefix="kb-bench-") as tmp:
+        store = VectorStore(dim, path=os.path.join(tmp, "index.faiss"), index_type=index_type,
+                            quantization=quantization, truncate_dim=truncate_dim, rescore=rescore)
+        retriever = Retriever(embedder, store, top_k=k, mode=mode, batch_queries=False, model=model)
+        try:
+            stages.append(bench_add(store, vectors, meta, batch))
+            texts = sample_queries(chunks, queries, seed=seed)
+            stages.append(bench_search(store, vectors, np.asarray(embedder.embed(texts), dtype="float32"), k))
+            stages.append(bench_retriever(retriever, texts, k, mode))
+        finally:
+            retriever.close()
+            store.close()
+    return result
+
+
+def compare(old: Dict, new: Dict) -> List[Dict]:
+    """Изменение числовых метрик по одноимённым этапам двух прогонов, в процентах."""
+    before = {s["stage"]: s for s in old.get("stages", [])}
+    rows = []
+    for stage in new.get("stages", []):
+        prev = before.get(stage["stage"])
+        if prev is None:
+            continue
+        for key, value in stage.items():
+            was = prev.get(key)
+            if isinstance(value, (int, float)) and isinstance(was, (int, float)) and was:
+                rows.append({"stage": stage["stage"], "metric": key, "old": was, "new": value,
+                             "change_pct": round((value - was) / was * 100, 1)})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=20, help="документов каждого формата")
+    parser.add_argument("--words", type=int, default=2000, help="слов в документе")
+    parser.add_argument("--formats", default=",".join(EXT_LOADERS), help="например .pdf,.docx,.txt")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--mode", default="hybrid", help="режим Retriever: hybrid | vector | keyword")
+    parser.add_argument("--dim", type=int, default=512, help="размерность LocalEmbedder")
+    parser.add_argument("--model", default="gpt-4o-mini", help="токенизатор для split_text")
+    parser.add_argument("--max-tokens", type=int, default=500)
+    parser.add_argument("--overlap", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=256)
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--quantization", default="none")
+    parser.add_argument("--truncate-dim", type=int)
+    parser.add_argument("--rescore", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="куда записать результаты (JSON)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    formats = tuple(f if f.startswith(".") else "." + f for f in args.formats.split(",") if f)
+    result = run(docs=args.docs, words=args.words, formats=formats, k=args.k, queries=args.queries, mode=args.mode,
+                 dim=args.dim, max_tokens=args.max_tokens, overlap=args.overlap, model=args.model, batch=args.batch,
+                 index_type=args.index_type, quantization=args.quantization, truncate_dim=args.truncate_dim,
+                 rescore=args.rescore, seed=args.seed)
+    print(f"commit {result['commit']}, {args.docs} documents x {len(formats)} formats, {args.words} words each")
+    for stage in result["stages"]:
+        print(json.dumps(stage, ensure_ascii=False))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            old = json.load(f)
+        print(f"compared with commit {old.get('commit')}")
+        for row in compare(old, result):
+            print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import requests
+
+from .sources import DocumentSource
+from .yandex_client import RemoteFile, YandexDiskClient
+
+YANDEX_DISK_REST = "https://cloud-api.yandex.net/v1/disk"
+
+
+class TokenRejected(Exception):
+    pass
+
+
+class ListingCache:
+    """
+    Список файлов базы знаний для /kb из памяти. Обновляется переиндексацией
+    (update) и сам по себе: устаревший (старше ttl) список отдаётся сразу, а свежий
+    запрашивается в фоне; одновременные промахи ждут один общий PROPFIND.
+
+    Для Я.Диска проверка токена через REST API кэшируется на token_ttl секунд,
+    поэтому не выполняется на каждую команду.
+    """
+    def __init__(self, source: DocumentSource, root_path: str, ttl: float = 300.0, token_ttl: float = 600.0):
+        self.source = source
+        self.root_path = root_path
+        self.ttl = ttl
+        self.token_ttl = token_ttl
+        self._paths: Optional[List[str]] = None
+        self._updated = 0.0
+        self._refresh: Optional[asyncio.Task] = None
+        self._token: Optional[Tuple[float, int, str]] = None  # (время проверки, статус, тело ответа)
+
+    @property
+    def age(self) -> Optional[float]:
+        return None if self._paths is None else time.monotonic() - self._updated
+
+    def update(self, files: Iterable[RemoteFile]):
+        """Новый список (например, полученный переиндексацией)."""
+        self._paths = sorted(f.path for f in files)
+        self._updated = time.monotonic()
+
+    def _list(self) -> List[RemoteFile]:
+        if isinstance(self.source, YandexDiskClient):
+            self.check_token()
+        return list(self.source.iter_files(self.root_path))
+
+    async def _do_refresh(self):
+        files = await asyncio.to_thread(self._list)
+        self.update(files)
+        logging.info("[KB] listing refreshed: %d files", len(self._paths))
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._do_refresh())
+            self._refresh.add_done_callback(self._refresh_done)
+        return self._refresh
+
+    def _refresh_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None and self._paths is not None:
+            # фоновое обновление: пользователь уже получил старый список
+            logging.warning("[KB] background listing refresh failed: %s", task.exception())
+
+    async def get(self) -> List[str]:
+        """Пути файлов; ждёт сеть только если списка ещё нет."""
+        if self._paths is None:
+            await asyncio.shield(self._start_refresh())
+        elif self.age > self.ttl:
+            self._start_refresh()
+        return self._paths
+
+    def check_token(self):
+        """TokenRejected, если REST API отверг токен; успешный результат кэшируется на token_ttl."""
+        cached = self._token
+        if cached is None or time.monotonic() - cached[0] > self.token_ttl:
+            r = requests.get(YANDEX_DISK_REST, headers=self.source.session.headers, timeout=10)
+            cached = (time.monotonic(), r.status_code, r.text)
+            # сетевые сбои и 5xx не кэшируем — следующий вызов проверит заново
+            self._token = cached if r.status_code < 500 else None
+        if cached[1] == 401:
+            raise TokenRejected(f"REST 401: {cached[2][:200]}")
+        if cached[1] >= 400:
+            raise RuntimeError(f"REST check error {cached[1]}: {cached[2][:200]}")
+
+    async def aclose(self):
+        # source общий с ReindexJob — его закрывает владелец
+        if self._refresh is not None:
+            self._refresh.cancel()
@@ -1,5 +1,5 @@
-import io, tempfile, csv, json
-from typing import Optional
+import io, os, tempfile, csv, json
+from typing import Iterator, Optional, Tuple
 from pypdf import PdfReader
 import docx2txt
 import pandas as pd
@@ -8,7 +8,7 @@ from pptx import Presentation
 class PasswordRequired(Exception):
     pass
 
-def load_pdf(content: bytes, password: Optional[str]=None) -> str:
+def iter_pdf_pages(content: bytes, password: Optional[str]=None) -> Iterator[str]:
     reader = PdfReader(io.BytesIO(content))
     if reader.is_encrypted:
         if not password:
@@ -17,26 +17,26 @@ def load_pdf(content: bytes, password: Optional[str]=None) -> str:
             reader.decrypt(password)
         except Exception:
             raise PasswordRequired("Wrong password")
-    text = []
     for page in reader.pages:
-        text.append(page.extract_text() or "")
-    return "\n".join(text)
+        yield page.extract_text() or ""
+
+def load_pdf(content: bytes, password: Optional[str]=None) -> str:
+    return "\n".join(iter_pdf_pages(content, password))
 
 def load_docx(content: bytes) -> str:
     with tempfile.NamedTemporaryFile(suffix=".docx") as f:
         f.write(content); f.flush()
         return docx2txt.process(f.name)
 
-def load_pptx(content: bytes) -> str:
+def iter_pptx_slides(content: bytes) -> Iterator[str]:
     with tempfile.NamedTemporaryFile(suffix=".pptx") as f:
         f.write(content); f.flush()
         prs = Presentation(f.name)
-    texts = []
     for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                texts.append(shape.text)
-    return "\n".join(texts)
+        yield "\n".join(shape.text for shape in slide.shapes if hasattr(shape, "text"))
+
+def load_pptx(content: bytes) -> str:
+    return "\n".join(t for t in iter_pptx_slides(content) if t)
 
 def load_excel(content: bytes) -> str:
     with tempfile.NamedTemporaryFile(suffix=".xlsx") as f:
@@ -71,3 +71,29 @@ EXT_LOADERS = {
     ".md": load_txt,
     ".html": load_txt,
 }
+
+def load_document(filename: str, content: bytes, password: Optional[str]=None) -> str:
+    ext = os.path.splitext(filename)[1].lower()
+    loader = EXT_LOADERS.get(ext)
+    if not loader:
+        raise ValueError(f"Unsupported file format: {filename}")
+    if ext == ".pdf":
+        return loader(content, password=password)
+    return loader(content)
+
+# Форматы, которые можно читать постранично (PDF) или по слайдам (PPTX)
+PAGE_LOADERS = {
+    ".pdf": iter_pdf_pages,
+    ".pptx": iter_pptx_slides,
+}
+
+def iter_pages(filename: str, content: bytes, password: Optional[str]=None) -> Iterator[Tuple[int, str]]:
+    """(номер страницы с 1, текст) по одной странице; прочие форматы — одной страницей."""
+    ext = os.path.splitext(filename)[1].lower()
+    loader = PAGE_LOADERS.get(ext)
+    if loader is None:
+        yield 1, load_document(filename, content, password)
+        return
+    pages = loader(content, password=password) if ext == ".pdf" else loader(content)
+    for no, text in enumerate(pages, start=1):
+        yield no, text
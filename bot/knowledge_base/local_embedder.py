@@ -0,0 +1,67 @@
+import asyncio
+import math
+import re
+import zlib
+from collections import Counter
+from typing import List
+
+import numpy as np
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+# тексты короче этого (символов) считаем прямо в цикле событий — это доли миллисекунды
+INLINE_CHARS = 4000
+
+
+class LocalEmbedder:
+    """
+    Эмбеддинги без сети и API: хэшированные признаки (слова, пары слов, символьные
+    n-граммы слов) с сублинейным весом 1 + log(tf), спроецированные знаковым хэшированием
+    в dim измерений и L2-нормированные. Признак -> (индекс, знак) через crc32, поэтому
+    векторы одинаковы между запусками и машинами. IDF не используется: эмбеддинг текста
+    не зависит от корпуса, и индекс не нужно пересчитывать при его росте.
+
+    Интерфейс как у Embedder (model, embed, aembed) — подходит для VectorStore и Retriever
+    без изменений. Качество ниже нейросетевых моделей: это лексическое сходство
+    для офлайн-развёртываний, CI и бенчмарков.
+    """
+    def __init__(self, dim: int = 512, ngram: int = 3, seed: int = 0):
+        self.dim = dim
+        self.ngram = ngram
+        self.seed = seed
+        self.model = f"local-hash-{dim}-n{ngram}-s{seed}"
+
+    def _features(self, text: str) -> Counter:
+        words = _WORD.findall(text.casefold())
+        feats = Counter(words)
+        feats.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+        n = self.ngram
+        for w in words:
+            padded = f"<{w}>"
+            feats.update("#" + padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+        return feats
+
+    def _vector(self, text: str) -> np.ndarray:
+        feats = self._features(text)
+        vec = np.zeros(self.dim, dtype=np.float32)
+        if not feats:
+            return vec
+        idx = np.empty(len(feats), dtype=np.int64)
+        weights = np.empty(len(feats), dtype=np.float32)
+        for pos, (feat, tf) in enumerate(feats.items()):
+            h = zlib.crc32(feat.encode("utf-8"), self.seed)
+            idx[pos] = h % self.dim
+            # старший бит хэша — знак: коллизии в среднем взаимно гасятся
+            weights[pos] = (1.0 + math.log(tf)) * (1.0 if h & 0x80000000 else -1.0)
+        np.add.at(vec, idx, weights)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm > 0 else vec
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t or "").tolist() for t in texts]
+
+    async def aembed(self, texts: List[str], urgent: bool = False) -> List[List[float]]:
+        if sum(len(t or "") for t in texts) <= INLINE_CHARS:
+            return self.embed(texts)
+        # пачки чанков при индексации считаем в потоке, чтобы не блокировать цикл событий
+        return await asyncio.to_thread(self.embed, texts)
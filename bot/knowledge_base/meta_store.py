@@ -0,0 +1,170 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class MetaStore:
+    """
+    Метаданные чанков в SQLite: id -> (file, chunk_no, text, page), текст сжат zlib.
+    Индекс по file позволяет удалять файл целиком, а текст читается только
+    для тех id, которые попали в выдачу.
+
+    Параллельно ведётся полнотекстовый индекс FTS5 (BM25) по тем же id — для поиска
+    точных идентификаторов и работы без API эмбеддингов. Таблица contentless:
+    текст в ней не дублируется, поэтому при удалении исходный текст передаётся явно.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " id INTEGER PRIMARY KEY, file TEXT NOT NULL, chunk_no INTEGER NOT NULL, text BLOB NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS chunks_file ON chunks(file);"
+            "CREATE TABLE IF NOT EXISTS tombstones (id INTEGER PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT);"
+        )
+        columns = {r[1] for r in self._db.execute("PRAGMA table_info(chunks)")}
+        if "page" not in columns:
+            self._db.execute("ALTER TABLE chunks ADD COLUMN page INTEGER")
+        self.fts = self._init_fts()
+        self._db.commit()
+
+    def _init_fts(self) -> bool:
+        exists = self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunks_fts'").fetchone()
+        if exists:
+            return True
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE chunks_fts USING fts5("
+                             "text, content='', tokenize='unicode61 remove_diacritics 2')")
+        except sqlite3.OperationalError as e:
+            logging.warning("[KB] SQLite FTS5 unavailable, keyword search disabled: %s", e)
+            return False
+        # уже проиндексированные чанки добавляем в новый полнотекстовый индекс
+        for i, t in self._db.execute("SELECT id, text FROM chunks").fetchall():
+            self._db.execute("INSERT INTO chunks_fts(rowid, text) VALUES (?, ?)", (i, zlib.decompress(t).decode("utf-8")))
+        return True
+
+    def _fts_delete(self, where: str, args: tuple):
+        if not self.fts:
+            return
+        rows = self._db.execute(f"SELECT id, text FROM chunks WHERE {where}", args).fetchall()
+        self._db.executemany(
+            "INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', ?, ?)",
+            [(i, zlib.decompress(t).decode("utf-8")) for i, t in rows],
+        )
+
+    # ------------------------------------------------------------------
+    # Чанки
+    # ------------------------------------------------------------------
+    def add(self, rows: Iterable[Tuple[int, str, int, str, Optional[int]]]):
+        rows = list(rows)
+        with self._lock:
+            if self.fts and rows:
+                # INSERT OR REPLACE: старый текст заменяемых id убираем из FTS
+                for start in range(0, len(rows), 500):
+                    part = [int(r[0]) for r in rows[start:start + 500]]
+                    self._fts_delete(f"id IN ({','.join('?' * len(part))})", tuple(part))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO chunks(id, file, chunk_no, text, page) VALUES (?, ?, ?, ?, ?)",
+                [(i, f, n, zlib.compress(t.encode("utf-8")), p) for i, f, n, t, p in rows],
+            )
+            if self.fts:
+                self._db.executemany("INSERT INTO chunks_fts(rowid, text) VALUES (?, ?)",
+                                     [(i, t) for i, _, _, t, _ in rows])
+
+    def get(self, ids: List[int]) -> Dict[int, tuple]:
+        if not ids:
+            return {}
+        out = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                part = [int(i) for i in ids[start:start + 500]]
+                rows = self._db.execute(
+                    f"SELECT id, file, chunk_no, text, page FROM chunks WHERE id IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for i, f, n, t, p in rows:
+                    out[i] = (f, n, zlib.decompress(t).decode("utf-8"), p)
+        return out
+
+    def ids_for_file(self, file: str) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT id FROM chunks WHERE file = ? ORDER BY id", (file,))]
+
+    def delete_file(self, file: str) -> List[int]:
+        with self._lock:
+            ids = self.ids_for_file(file)
+            self._fts_delete("file = ?", (file,))
+            self._db.execute("DELETE FROM chunks WHERE file = ?", (file,))
+            return ids
+
+    def delete_ids(self, ids: List[int]):
+        with self._lock:
+            for i in ids:
+                self._fts_delete("id = ?", (int(i),))
+            self._db.executemany("DELETE FROM chunks WHERE id = ?", [(int(i),) for i in ids])
+
+    def keyword_search(self, query: str, k: int = 10) -> List[Tuple[int, float]]:
+        """BM25 по FTS5: [(id, score)], больший score — лучше. Слова запроса объединяются через OR."""
+        terms = re.findall(r"\w+", query.casefold())
+        if not self.fts or not terms:
+            return []
+        match = " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY bm25(chunks_fts) LIMIT ?",
+                (match, k)).fetchall()
+        # bm25() в SQLite отрицательный: чем меньше, тем релевантнее
+        return [(int(i), -float(score)) for i, score in rows]
+
+    def live_ids(self) -> Iterator[int]:
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM chunks ORDER BY id").fetchall()
+        for (i,) in rows:
+            yield i
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # Tombstones и служебные значения
+    # ------------------------------------------------------------------
+    def add_tombstones(self, ids: Iterable[int]):
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO tombstones(id) VALUES (?)", [(int(i),) for i in ids])
+
+    def tombstones(self) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT id FROM tombstones")]
+
+    def clear_tombstones(self):
+        with self._lock:
+            self._db.execute("DELETE FROM tombstones")
+
+    def get_value(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_value(self, key: str, value):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO kv(key, value) VALUES (?, ?)", (key, str(value)))
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def rollback(self):
+        with self._lock:
+            self._db.rollback()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
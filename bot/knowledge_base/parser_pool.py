@@ -0,0 +1,232 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, Iterator, Optional, Tuple
+
+from .loaders import iter_pages, load_document
+
+
+class ParseTimeout(Exception):
+    pass
+
+
+class ParseFailed(Exception):
+    pass
+
+
+def _on_cpu_limit(signum, frame):
+    raise ParseTimeout("CPU time limit exceeded")
+
+
+def _worker_init():
+    # Ctrl+C обрабатывает родительский процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGPROF, _on_cpu_limit)
+
+
+def _parse_in_worker(filename: str, content: bytes, password: Optional[str], cpu_timeout: Optional[float]):
+    # ITIMER_PROF считает процессорное время именно этого воркера
+    limited = bool(cpu_timeout) and hasattr(signal, "setitimer")
+    if limited:
+        signal.setitimer(signal.ITIMER_PROF, cpu_timeout)
+    try:
+        return load_document(filename, content, password=password)
+    finally:
+        if limited:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+def _stream_in_worker(filename: str, content: bytes, password: Optional[str], cpu_timeout: Optional[float], conn):
+    # страницы уходят в канал по одной; пока родитель не прочитал, send блокируется,
+    # и время ожидания в ITIMER_PROF не входит
+    limited = bool(cpu_timeout) and hasattr(signal, "setitimer")
+    if limited:
+        signal.setitimer(signal.ITIMER_PROF, cpu_timeout)
+    try:
+        for page in iter_pages(filename, content, password=password):
+            conn.send(page)
+        conn.send(None)
+    finally:
+        if limited:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        conn.close()
+
+
+class PageStream:
+    """
+    Страницы документа из воркера по мере разбора (ParsePool.pages). Итерируется
+    синхронно — из потока, как и остальная обработка текста; timeout — суммарное
+    ожидание страниц, время обработки уже полученных в него не входит.
+    """
+    def __init__(self, filename: str, conn, future: Future, executor: ProcessPoolExecutor, timeout: float):
+        self.filename = filename
+        self._conn = conn
+        self._future = future
+        self._executor = executor
+        self._left = timeout
+        self._lock = threading.Lock()
+        self._closed = False
+        self._first = None
+        self.failed = False  # воркер завис или упал — пул нужно пересоздать
+
+    def _recv(self):
+        with self._lock:
+            started = time.monotonic()
+            try:
+                while True:
+                    if self._closed:
+                        raise ParseFailed(f"{self.filename}: stream closed")
+                    if self._conn.poll(0.05):
+                        return self._conn.recv()
+                    if self._future.done():
+                        if self._conn.poll():
+                            return self._conn.recv()
+                        # исключение воркера (PasswordRequired, ParseTimeout, падение процесса)
+                        self._future.result()
+                        raise ParseFailed(f"{self.filename}: worker exited without finishing")
+                    if time.monotonic() - started > self._left:
+                        self.failed = True
+                        raise ParseTimeout(f"{self.filename}: parsing timed out")
+            except BrokenProcessPool:
+                self.failed = True
+                raise
+            finally:
+                self._left -= time.monotonic() - started
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        page, self._first = self._first, None
+        while page is not None:
+            yield page
+            try:
+                page = self._recv()
+            except BrokenProcessPool as e:
+                raise ParseFailed(f"{self.filename}: parse worker crashed") from e
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            self._conn.close()
+
+
+class ParsePool:
+    """
+    Пул процессов для разбора документов (EXT_LOADERS).
+    Каждый документ ограничен по CPU (cpu_timeout) и по общему времени (timeout);
+    зависший или упавший воркер приводит к пересозданию пула, а не к зависанию бота.
+    В пул одновременно отдаётся не больше workers документов, и timeout отсчитывается
+    с момента, когда документ получил воркер, а не с постановки в очередь.
+    """
+    def __init__(self, workers: Optional[int] = None, cpu_timeout: float = 60.0, timeout: float = 120.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.cpu_timeout = cpu_timeout
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(self.workers)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_worker_init,
+            )
+        return self._executor
+
+    def _restart(self, executor: ProcessPoolExecutor):
+        if self._executor is not executor:
+            return  # уже пересоздан другим вызовом
+        self._executor = None
+        # зависшие процессы нельзя отменить штатно — завершаем их
+        for proc in list((getattr(executor, "_processes", None) or {}).values()):
+            if proc.is_alive():
+                proc.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def parse(self, filename: str, content: bytes, password: Optional[str] = None) -> str:
+        """Извлекает текст документа в отдельном процессе. PasswordRequired пробрасывается как есть."""
+        return await self._run(filename, content, password)
+
+    @contextlib.asynccontextmanager
+    async def pages(self, filename: str, content: bytes, password: Optional[str] = None) -> AsyncIterator[PageStream]:
+        """
+        Как parse(), но страницы (номер, текст) приходят по мере разбора, без склейки
+        и без накопления всего документа в памяти. Ошибки разбора — как у parse(),
+        при открытии или во время итерации; упавший до первой страницы воркер повторяется.
+        """
+        async with self._slots:
+            stream = await self._open_stream(filename, content, password)
+            try:
+                yield stream
+            finally:
+                await asyncio.to_thread(stream.close)
+                await self._finish_stream(stream)
+
+    async def _open_stream(self, filename: str, content: bytes, password: Optional[str]) -> PageStream:
+        ctx = multiprocessing.get_context("spawn")
+        for attempt in range(2):
+            executor = self._get_executor()
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            future = executor.submit(_stream_in_worker, filename, content, password, self.cpu_timeout, send_conn)
+            stream = PageStream(filename, recv_conn, future, executor, self.timeout)
+            try:
+                stream._first = await asyncio.to_thread(stream._recv)
+                return stream
+            except BrokenProcessPool:
+                # воркер упал до первой страницы — возможно, на чужом документе; повторяем один раз
+                logging.error("[KB] parse worker crashed on %s (attempt %d)", filename, attempt + 1)
+                await asyncio.to_thread(stream.close)
+                self._restart(executor)
+            except BaseException:
+                await asyncio.to_thread(stream.close)
+                await self._finish_stream(stream)
+                raise
+            finally:
+                # копию передал в воркер пул; своя родителю не нужна
+                send_conn.close()
+        raise ParseFailed(f"{filename}: parse worker crashed")
+
+    async def _finish_stream(self, stream: PageStream):
+        if not stream.failed:
+            # без читателя воркер получит BrokenPipeError на ближайшей странице; слот
+            # освобождаем, когда он действительно закончил
+            done, _ = await asyncio.wait([asyncio.wrap_future(stream._future)], timeout=self.timeout)
+            if done:
+                done.pop().exception()  # ошибка уже передана читателю или не нужна
+                return
+        logging.error("[KB] parsing %s timed out or crashed, restarting parse pool", stream.filename)
+        self._restart(stream._executor)
+
+    async def _run(self, filename: str, content: bytes, password: Optional[str]):
+        async with self._slots:
+            return await self._run_in_slot(filename, content, password)
+
+    async def _run_in_slot(self, filename: str, content: bytes, password: Optional[str]):
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._get_executor()
+            future = loop.run_in_executor(executor, _parse_in_worker, filename, content, password,
+                                          self.cpu_timeout)
+            try:
+                return await asyncio.wait_for(future, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                logging.error("[KB] parsing %s exceeded %.0fs, restarting parse pool", filename, self.timeout)
+                self._restart(executor)
+                raise ParseTimeout(f"{filename}: parsing timed out")
+            except BrokenProcessPool:
+                # воркер упал (segfault, OOM) — возможно, на чужом документе; повторяем один раз
+                logging.error("[KB] parse worker crashed on %s (attempt %d)", filename, attempt + 1)
+                self._restart(executor)
+        raise ParseFailed(f"{filename}: parse worker crashed")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -25,3 +25,8 @@ def store_pdf_password(filename: str, password: str) -> None:
 
 def get_pdf_password(filename: str) -> Optional[str]:
     return _pdf_passwords.get(filename)
+
+
+def pdf_passwords() -> Dict[str, str]:
+    """Копия всех сохранённых паролей (для переиндексации)."""
+    return dict(_pdf_passwords)
@@ -0,0 +1,131 @@
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .splitter import get_encoder, token_char_offsets
+
+
+@dataclass
+class Passage:
+    file: str
+    first_chunk: int
+    last_chunk: int
+    page: Optional[int]
+    text: str
+    score: float
+    vector: Optional[np.ndarray] = None
+
+
+def strip_overlap(prev: str, nxt: str, overlap: int = 50, model: str = "gpt-4o-mini") -> str:
+    """Убирает из начала nxt текст, который уже есть в конце prev (перекрытие соседних чанков)."""
+    if not prev or not nxt or overlap <= 0:
+        return nxt
+    enc = get_encoder(model)
+    # ожидаемая граница: первые overlap токенов следующего чанка
+    tokens = enc.encode_ordinary(nxt[:overlap * 16])
+    if len(tokens) > overlap:
+        cut = int(token_char_offsets(enc, nxt[:overlap * 16], tokens)[overlap])
+        if prev.endswith(nxt[:cut]):
+            return nxt[cut:]
+    # токенизация на стыке могла разойтись — ищем наибольший суффикс prev, совпадающий с началом nxt
+    probe = nxt[:32]
+    start = max(0, len(prev) - overlap * 16)
+    best = None
+    pos = prev.rfind(probe, start)
+    while pos >= 0:
+        if nxt.startswith(prev[pos:]):
+            best = pos
+        pos = prev.rfind(probe, start, pos + len(probe) - 1)
+    return nxt if best is None else nxt[len(prev) - best:]
+
+
+def merge_adjacent(hits: Sequence[Tuple[tuple, float, Optional[np.ndarray]]], overlap: int = 50,
+                   model: str = "gpt-4o-mini") -> List[Passage]:
+    """
+    hits: [((file, chunk_no, text, page), score, vector)]. Соседние чанки одного файла
+    склеиваются в один фрагмент без повторения перекрытия; score — лучший из склеенных,
+    vector — нормированная сумма векторов.
+    """
+    passages: List[Passage] = []
+    for meta, score, vector in sorted(hits, key=lambda h: (h[0][0], h[0][1])):
+        file, chunk_no, text = meta[0], meta[1], meta[2]
+        page = meta[3] if len(meta) > 3 else None
+        last = passages[-1] if passages else None
+        if last is not None and last.file == file and last.last_chunk + 1 == chunk_no:
+            last.text += strip_overlap(last.text, text, overlap, model)
+            last.last_chunk = chunk_no
+            last.score = max(last.score, score)
+            if last.vector is not None and vector is not None:
+                last.vector = last.vector + vector
+            continue
+        passages.append(Passage(file, chunk_no, chunk_no, page, text, score,
+                                None if vector is None else np.asarray(vector, dtype="float32")))
+    return passages
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def mmr(relevance: np.ndarray, vectors: Optional[np.ndarray], k: int, lambda_: float = 0.7) -> List[int]:
+    """
+    Maximal marginal relevance: индексы в порядке выбора,
+    argmax(lambda * relevance - (1 - lambda) * max_sim к уже выбранным).
+    """
+    n = len(relevance)
+    k = min(k, n)
+    if vectors is None or n == 0:
+        return [int(i) for i in np.argsort(-relevance)[:k]]
+    unit = _normalize(vectors)
+    sims = unit @ unit.T
+    chosen: List[int] = []
+    max_sim = np.full(n, -np.inf)
+    available = np.ones(n, dtype=bool)
+    for _ in range(k):
+        penalty = np.where(np.isfinite(max_sim), max_sim, 0.0)
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * penalty, -np.inf)
+        best = int(np.argmax(scores))
+        chosen.append(best)
+        available[best] = False
+        max_sim = np.maximum(max_sim, sims[best])
+    return chosen
+
+
+def fit_budget(passages: Sequence[Passage], token_budget: int, model: str = "gpt-4o-mini") -> List[Passage]:
+    """Берёт фрагменты по порядку, пока они помещаются в token_budget; не влезший пропускается."""
+    enc = get_encoder(model)
+    counts = [len(t) for t in enc.encode_ordinary_batch([p.text for p in passages])]
+    out, used = [], 0
+    for p, n in zip(passages, counts):
+        if used + n <= token_budget:
+            out.append(p)
+            used += n
+    return out
+
+
+def select_context(hits: Sequence[Tuple[tuple, float, Optional[np.ndarray]]], query_vector: Optional[Sequence[float]],
+                   token_budget: int, overlap: int = 50, lambda_: float = 0.7,
+                   model: str = "gpt-4o-mini", score_weight: float = 0.5) -> List[Passage]:
+    """
+    Склейка соседних чанков -> MMR по фрагментам -> отбор в пределах token_budget.
+    Релевантность — смесь косинуса к запросу и переданного score (RRF векторной и BM25
+    выдач) с весом score_weight; без вектора запроса — только score.
+    """
+    passages = merge_adjacent(hits, overlap, model)
+    if not passages:
+        return []
+    have_vectors = all(p.vector is not None for p in passages)
+    vectors = np.stack([p.vector for p in passages]) if have_vectors else None
+    fused = np.array([p.score for p in passages], dtype="float32")
+    fused = fused / max(float(fused.max()), 1e-12)
+    if vectors is not None and query_vector is not None:
+        q = _normalize(np.asarray(query_vector, dtype="float32").reshape(1, -1))
+        cosine = (_normalize(vectors) @ q.T).ravel()
+        # score приводим к шкале косинуса, с которой MMR сравнивает штраф за сходство
+        relevance = (1 - score_weight) * cosine + score_weight * fused * max(float(cosine.max()), 0.0)
+    else:
+        relevance = fused
+    order = mmr(relevance, vectors, len(passages), lambda_)
+    return fit_budget([passages[i] for i in order], token_budget, model)
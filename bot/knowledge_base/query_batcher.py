@@ -0,0 +1,78 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Tuple
+
+from .vector_store import VectorStore
+
+
+class QueryBatcher:
+    """
+    Собирает запросы, пришедшие в пределах max_wait секунд (не больше max_batch),
+    и выполняет для них один запрос эмбеддингов и один index.search по матрице (n, dim).
+    Результаты раздаются ожидающим вызовам; отменённые вызовы просто пропускаются.
+    Запросы к разным снимкам индекса ищутся каждый в своём.
+    """
+    def __init__(self, embedder, executor: Optional[Executor] = None, max_batch: int = 32, max_wait: float = 0.005):
+        self.embedder = embedder
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending: List[Tuple[str, Optional[list], int, asyncio.Future, VectorStore]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._full: Optional[asyncio.Event] = None
+
+    async def search(self, store: VectorStore, query: str, vector: Optional[list],
+                     k: int) -> Tuple[list, List[Tuple[int, float]]]:
+        """(вектор запроса, [(id, distance)]). vector=None — эмбеддинг посчитается в общем батче."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((query, vector, k, future, store))
+        if self._flusher is None or self._flusher.done():
+            self._full = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush())
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def _flush(self):
+        # ждём соседние запросы, но не дольше max_wait
+        try:
+            await asyncio.wait_for(self._full.wait(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        pending, self._pending = self._pending, []
+        self._flusher = None
+        await asyncio.gather(*(self._run(pending[i:i + self.max_batch])
+                               for i in range(0, len(pending), self.max_batch)))
+
+    async def _run(self, batch):
+        batch = [item for item in batch if not item[3].done()]
+        if not batch:
+            return
+        vectors = [item[1] for item in batch]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        try:
+            if missing:
+                # батч уже собран здесь — linger эмбеддера не ждём
+                fresh = await self.embedder.aembed([batch[i][0] for i in missing], urgent=True)
+                for i, v in zip(missing, fresh):
+                    vectors[i] = v
+            # обычно снимок один; во время публикации нового — два
+            groups: Dict[int, List[int]] = {}
+            for i, item in enumerate(batch):
+                groups.setdefault(id(item[4]), []).append(i)
+            loop = asyncio.get_running_loop()
+            hits: List[list] = [None] * len(batch)
+            for rows in groups.values():
+                store = batch[rows[0]][4]
+                k = max(batch[i][2] for i in rows)
+                found = await loop.run_in_executor(self.executor, store.search_ids_batch, [vectors[i] for i in rows], k)
+                for i, row in zip(rows, found):
+                    hits[i] = row
+        except Exception as e:
+            for item in batch:
+                if not item[3].done():
+                    item[3].set_exception(e)
+            return
+        for (_, _, n, future, _), vector, row in zip(batch, vectors, hits):
+            if not future.done():
+                future.set_result((vector, row[:n]))
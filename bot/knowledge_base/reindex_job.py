@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional, Tuple
+
+from .listing_cache import ListingCache
+from .parser_pool import ParsePool
+from .passwords import pdf_passwords
+from .reindexer import _store_call, load_state, plan_changes, reindex
+from .snapshots import IndexSnapshots
+from .sources import DocumentSource
+
+Report = Callable[[str], Awaitable[None]]
+
+
+class ReindexBusy(Exception):
+    pass
+
+
+class ReindexJob:
+    """
+    Фоновая переиндексация базы знаний. Одновременно идёт не больше одного прогона,
+    его можно отменить через cancel(); прогресс не чаще раза в progress_interval
+    секунд передаётся в report (например, редактирование одного сообщения).
+
+    Индекс строится в новом снимке (IndexSnapshots.prepare), поэтому поиск до конца
+    прогона обслуживается прежним; после успеха снимок публикуется. Если по сравнению
+    с опубликованным снимком ничего не изменилось, снимок не создаётся (или удаляется). Прерванный прогон
+    продолжается в том же снимке со своей контрольной точки. Список файлов,
+    полученный прогоном, обновляет listing (кэш /kb).
+
+    source — источник документов (YandexDiskClient, LocalSource), общий с ListingCache:
+    пул соединений живёт всё время работы бота, закрывает его владелец.
+    """
+    def __init__(self, root_path: str, source: DocumentSource, snapshots: IndexSnapshots,
+                 embedder, parser: Optional[ParsePool] = None, listing: Optional[ListingCache] = None,
+                 progress_interval: float = 5.0, **options):
+        self.root_path = root_path
+        self.source = source
+        self.snapshots = snapshots
+        self.embedder = embedder
+        self.parser = parser
+        self.listing = listing
+        self.progress_interval = progress_interval
+        self.options = options
+        self.last_result: Optional[Tuple[int, int]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def cancel(self) -> bool:
+        if not self.running:
+            return False
+        self._task.cancel()
+        return True
+
+    async def _report_loop(self, report: Report, progress: dict, changed: asyncio.Event):
+        while True:
+            await changed.wait()
+            changed.clear()
+            text = f"Индексация: {progress['step']}/{progress['total']}\n{progress['file']}"
+            try:
+                await report(text)
+            except Exception as e:
+                # например, «message is not modified» или флуд-лимит — просто пропускаем
+                logging.debug("[KB] progress report failed: %s", e)
+            await asyncio.sleep(self.progress_interval)
+
+    async def _report(self, report: Optional[Report], text: str):
+        logging.info("[KB] %s", text)
+        if report is None:
+            return
+        try:
+            await report(text)
+        except Exception as e:
+            logging.warning("[KB] progress report failed: %s", e)
+
+    async def run(self, report: Optional[Report] = None) -> Tuple[int, int]:
+        """Один прогон reindex(); ReindexBusy, если предыдущий ещё не закончился."""
+        if self.running:
+            raise ReindexBusy("reindex is already running")
+        self._task = asyncio.current_task()
+        progress = {"step": 0, "total": 0, "file": ""}
+        changed = asyncio.Event()
+
+        def progress_cb(step, total, filename):
+            progress.update(step=step, total=total, file=filename)
+            changed.set()
+
+        reporter = asyncio.create_task(self._report_loop(report, progress, changed)) if report else None
+        started = time.monotonic()
+        source = self.source
+        name, store = None, None
+        try:
+            files = await asyncio.to_thread(lambda: list(source.iter_files(self.root_path)))
+            published = await asyncio.to_thread(load_state, self.snapshots.state_path(self.snapshots.current))
+            to_fetch, gone = plan_changes(files, published)
+            if to_fetch or gone or self.snapshots.has_unfinished():
+                name, store = await asyncio.to_thread(self.snapshots.prepare)
+                added, total = await reindex(self.root_path, source, store, self.embedder, pdf_passwords(),
+                                             progress_cb=progress_cb, parser=self.parser,
+                                             state_path=self.snapshots.state_path(name), files=files,
+                                             listing_cb=self.listing.update if self.listing else None,
+                                             **self.options)
+            else:
+                # ничего не изменилось: снимок не копируем и не публикуем
+                if self.listing:
+                    self.listing.update(files)
+                added, total = 0, len(files)
+            changed_index = store is not None
+            if changed_index:
+                # дальше снимок принадлежит publish/discard: при отмене они всё равно доработают,
+                # а store закроют сами
+                finished, store = store, None
+                if await asyncio.to_thread(load_state, self.snapshots.state_path(name)) == published:
+                    # все файлы не скачались или не разобрались — индекс тот же, что опубликован
+                    await _store_call(self.snapshots.discard, name, finished)
+                    changed_index = False
+                else:
+                    await _store_call(self.snapshots.publish, name, finished)
+        except BaseException as e:
+            if store is not None:
+                store.close()
+            if reporter is not None:
+                reporter.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                # контрольная точка уже на диске — следующий прогон продолжит с неё
+                await self._report(report, f"Индексация отменена на {progress['step']}/{progress['total']}.")
+            elif isinstance(e, Exception):
+                await self._report(report, f"Ошибка индексации: {e}")
+            raise
+        finally:
+            # прогон считается идущим, пока снимок не опубликован или не удалён: иначе следующий
+            # prepare() продолжил бы тот же снимок одновременно с публикацией
+            self._task = None
+        if reporter is not None:
+            reporter.cancel()
+        self.last_result = (added, total)
+        elapsed = time.monotonic() - started
+        if not changed_index:
+            await self._report(report, f"Индексация завершена за {elapsed:.0f} с: изменений нет ({total} файлов).")
+            return added, total
+        stats = await asyncio.to_thread(self._published_stats)
+        await self._report(report, f"Индексация завершена за {elapsed:.0f} с: "
+                                   f"обновлено {added} из {total} файлов.{stats}")
+        return added, total
+
+    def _published_stats(self) -> str:
+        # опубликованный снимок закреплён на время подсчёта: полный проход recall_at_k
+        # идёт вне прогона и не мешает следующему
+        with self.snapshots.acquire() as store:
+            return self._index_stats(store)
+
+    @staticmethod
+    def _index_stats(store) -> str:
+        """Память под векторы и влияние сжатия на recall@10 — для отчёта о прогоне."""
+        mem = store.memory_stats()
+        if not mem["vectors"]:
+            return ""
+        mb = 1024 * 1024
+        text = (f"\nВекторов: {mem['vectors']}, индекс ≈{mem['index_bytes'] / mb:.1f} МБ "
+                f"(float32: {mem['float32_bytes'] / mb:.1f} МБ, экономия {1 - mem['index_bytes'] / mem['float32_bytes']:.0%}).")
+        recall = store.recall_at_k(k=10)
+        if recall is not None:
+            text += f"\nrecall@10: {recall['recall']:.3f} (без пересчёта {recall['recall_no_rescore']:.3f})."
+        return text
+
+    async def watch(self, interval: float = 2.0):
+        """
+        Следит за источником с fingerprint() (LocalSource) и запускает прогон, как только
+        дерево изменилось и затем не менялось interval секунд (файл успел дописаться).
+        Первый прогон — сразу: за время простоя файлы тоже могли измениться.
+        Пока каталог недоступен, прогоны не запускаются.
+        """
+        last, dirty, available = None, True, True
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                current = await asyncio.to_thread(self.source.fingerprint, self.root_path)
+            except OSError as e:
+                # каталог пропал или не смонтирован: индекс не трогаем, ждём его возвращения
+                if available:
+                    logging.warning("[KB] watched directory unavailable: %s", e)
+                last, dirty, available = None, True, False
+                continue
+            available = True
+            if current != last:
+                last, dirty = current, True
+                continue
+            if not dirty or self.running:
+                continue
+            dirty = False
+            # отдельная задача: cancel() из /reindex не должен останавливать наблюдение
+            task = asyncio.create_task(self.run())
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            if task.cancelled():
+                continue  # отменили вручную — ждём следующего изменения
+            if isinstance(task.exception(), ReindexBusy):
+                dirty = True
+            elif task.exception() is not None:
+                logging.warning("[KB] watched reindex failed: %s", task.exception())
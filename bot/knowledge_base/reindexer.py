@@ -1,60 +1,220 @@
-import os, json, time
-from typing import Dict, Optional
-from .yandex_client import YandexDiskClient
-from .loaders import EXT_LOADERS, PasswordRequired
-from .splitter import split_text
-from .embedder import Embedder
+import os, json, time, asyncio, logging
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+from .yandex_client import RemoteFile, YandexDiskClient
+from .sources import DocumentSource
+from .loaders import EXT_LOADERS, PasswordRequired, iter_pages
+from .parser_pool import ParsePool, ParseTimeout, ParseFailed
+from .splitter import iter_chunks
+from .embedder import TextEmbedder
 from .vector_store import VectorStore
 
 INDEX_STATE = "data/kb_state.json"
 
-def load_state() -> Dict[str, str]:
-    if os.path.exists(INDEX_STATE):
-        with open(INDEX_STATE, "r", encoding="utf-8") as f:
+def load_state(path: str = INDEX_STATE) -> Dict[str, str]:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     return {}
 
-def save_state(state: Dict[str, str]):
-    os.makedirs(os.path.dirname(INDEX_STATE), exist_ok=True)
-    with open(INDEX_STATE, "w", encoding="utf-8") as f:
+def save_state(state: Dict[str, str], path: str = INDEX_STATE):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(state, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
-async def reindex(root_path: str, yd: YandexDiskClient, store: VectorStore, emb: Embedder, pdf_passwords: Dict[str, str], chunk_tokens=500, overlap=50, model="gpt-4o-mini", progress_cb=None):
-    """Асинхронная индексация. progress_cb(step, total, filename) -> None"""
-    state = load_state()
-    files = list(yd.iter_files(root_path))
+async def _store_call(fn, *args):
+    """
+    fn(*args) в потоке. При отмене дожидается конца вызова: иначе ReindexJob закрыл бы
+    store, пока поток ещё меняет индекс.
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        while not task.done():
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                pass
+        raise
+
+def _chunk_batches(pages: Iterable[Tuple[int, str]], chunk_tokens: int, overlap: int, model: str,
+                   batch_size: int) -> Iterator[List[Tuple[int, str]]]:
+    batch = []
+    for chunk in iter_chunks(pages, max_tokens=chunk_tokens, overlap=overlap, model=model):
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def _thread_batches(pages: Iterable[Tuple[int, str]], chunk_tokens: int, overlap: int, model: str,
+                          batch_size: int) -> AsyncIterator[List[Tuple[int, str]]]:
+    batches = _chunk_batches(pages, chunk_tokens, overlap, model, batch_size)
+    while True:
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None:
+            return
+        yield batch
+
+async def _iter_chunk_batches(remote_path: str, content: bytes, pdf_passwords: Dict[str, str], parser: Optional[ParsePool],
+                              chunk_tokens: int, overlap: int, model: str, batch_size: int) -> AsyncIterator[List[Tuple[int, str]]]:
+    """Страницы -> окно токенов -> пачки (страница, чанк); весь текст документа целиком не собирается."""
+    password = pdf_passwords.get(os.path.basename(remote_path))
+    if parser is None:
+        async for batch in _thread_batches(iter_pages(remote_path, content, password),
+                                           chunk_tokens, overlap, model, batch_size):
+            yield batch
+        return
+    # страницы приходят из воркера по мере разбора, в памяти — только ещё не нарезанные
+    async with parser.pages(remote_path, content, password) as pages:
+        async for batch in _thread_batches(pages, chunk_tokens, overlap, model, batch_size):
+            yield batch
+
+def plan_changes(files: List[RemoteFile], state: Dict[str, str]) -> Tuple[List[RemoteFile], List[str]]:
+    """(файлы, которые нужно скачать и проиндексировать, пути исчезнувших файлов) относительно state."""
+    to_fetch = [rf for rf in files
+                if os.path.splitext(rf.path)[1].lower() in EXT_LOADERS and state.get(rf.path) != rf.signature]
+    listed = {rf.path for rf in files}
+    return to_fetch, [p for p in state if p not in listed]
+
+async def reindex(root_path: str, source: DocumentSource, store: VectorStore, emb: TextEmbedder, pdf_passwords: Dict[str, str], chunk_tokens=500, overlap=50, model="gpt-4o-mini", progress_cb=None,
+                  download_concurrency=4, download_timeout=120.0, download_retries=3, parser: Optional[ParsePool]=None,
+                  checkpoint_files=50, checkpoint_seconds=60.0, chunk_batch=64, state_path=INDEX_STATE,
+                  listing_cb=None, files: Optional[List[RemoteFile]]=None):
+    """
+    Асинхронная индексация. progress_cb(step, total, filename) -> None,
+    listing_cb(files) -> None получает полный список файлов на диске (например, для кэша /kb).
+    source — откуда берутся документы: Я.Диск или локальный каталог (sources.DocumentSource);
+    files — уже полученный список файлов, чтобы не запрашивать его повторно.
+
+    Документ обрабатывается потоком: страницы режутся на чанки скользящим окном
+    и уходят на эмбеддинг пачками по chunk_batch, поэтому память на документ
+    ограничена окном, а не размером файла. У каждого чанка сохраняется номер страницы.
+
+    Каждые checkpoint_files файлов или checkpoint_seconds секунд индекс, метаданные
+    и kb_state.json атомарно сохраняются; после сбоя следующий запуск продолжает
+    с последней контрольной точки (файлы после неё просто обрабатываются заново).
+    state_path должен соответствовать store (у каждого снимка индекса — свой).
+    """
+    state = load_state(state_path)
+    if files is None:
+        files = await asyncio.to_thread(lambda: list(source.iter_files(root_path)))
+    if not files and state:
+        # скорее пропавший диск или каталог, чем удалённая целиком база знаний
+        raise RuntimeError(f"{root_path} is empty; refusing to remove all {len(state)} indexed files")
+    if listing_cb:
+        listing_cb(files)
     total = len(files)
     added = 0
-    for idx, (remote_path, _) in enumerate(files, start=1):
-        if progress_cb:
-            progress_cb(idx, total, remote_path)
-        try:
-            content = yd.download(remote_path)
-        except Exception as e:
+    step = 0
+    to_fetch, gone = plan_changes(files, state)
+    fetch_paths = {rf.path for rf in to_fetch}
+    for rf in files:
+        if rf.path in fetch_paths:
             continue
-        sig = YandexDiskClient.file_signature(content)
-        if state.get(remote_path) == sig:
-            continue  # unchanged
-        ext = os.path.splitext(remote_path)[1].lower()
-        loader = EXT_LOADERS.get(ext)
-        if not loader:
-            continue
-        text = ""
+        step += 1  # неподдерживаемый или неизменившийся файл — не скачиваем
+        if progress_cb:
+            progress_cb(step, total, rf.path)
+
+    # файлы, исчезнувшие с диска, убираем из индекса
+    if gone:
+        await _store_call(lambda: [store.delete_file(p) for p in gone])
+    for path in gone:
+        del state[path]
+
+    # изменения store/state и контрольные точки не должны пересекаться; сами изменения
+    # (add с обучением IVF/int8, удаления с FTS) идут в потоке, чтобы не блокировать бота
+    lock = asyncio.Lock()
+    pending = 0
+    last_checkpoint = time.monotonic()
+
+    async def checkpoint(force=False):
+        nonlocal pending, last_checkpoint
+        async with lock:
+            due = pending >= checkpoint_files or time.monotonic() - last_checkpoint >= checkpoint_seconds
+            if not force and not (pending and due):
+                return
+            if force:
+                await _store_call(store.maybe_compact)
+            snapshot = dict(state)
+            # порядок важен: сначала индекс+метаданные, потом состояние
+            await _store_call(store.save)
+            await asyncio.to_thread(save_state, snapshot, state_path)
+            pending = 0
+            last_checkpoint = time.monotonic()
+
+    # одновременно разбираем столько документов, сколько воркеров в пуле
+    slots = asyncio.Semaphore(parser.workers if parser is not None else 1)
+    tasks = set()
+
+    async def process(rf, content):
+        nonlocal added, pending
+        new_ids = []
+        chunk_no = 0
+        ok = False
+        batches = _iter_chunk_batches(rf.path, content, pdf_passwords, parser,
+                                      chunk_tokens, overlap, model, chunk_batch)
         try:
-            if ext==".pdf":
-                password = pdf_passwords.get(os.path.basename(remote_path))
-                text = loader(content, password=password)
-            else:
-                text = loader(content)
+            # внутри try: при ошибке или отмене слот разбора всё равно освобождается
+            old_ids = await _store_call(store.file_ids, rf.path)
+            async for batch in batches:
+                # aembed упаковывает чанки соседних файлов в общие батчи
+                vectors = await emb.aembed([text for _, text in batch])
+                meta = [(rf.path, chunk_no + i, text, page) for i, (page, text) in enumerate(batch)]
+                chunk_no += len(batch)
+                async with lock:
+                    new_ids.extend(await _store_call(store.add, vectors, meta))
+            ok = True
         except PasswordRequired:
             # пропускаем, попросим пароль у пользователя
-            continue
-        chunks = split_text(text, max_tokens=chunk_tokens, overlap=overlap, model=model)
-        vectors = emb.embed(chunks)
-        meta = [(remote_path, i, chunks[i]) for i in range(len(chunks))]
-        store.add(vectors, meta)
-        state[remote_path] = sig
-        added += 1
-    store.save()
-    save_state(state)
+            pass
+        except (ParseTimeout, ParseFailed) as e:
+            logging.warning("[KB] skipping %s: %s", rf.path, e)
+        except Exception as e:
+            logging.exception("[KB] failed to index %s: %s", rf.path, e)
+        finally:
+            # воркер разбора освобождается сразу, а не при сборке мусора генератора
+            await batches.aclose()
+            slots.release()
+        async with lock:
+            if not ok:
+                # недоиндексированный файл откатываем, старые векторы остаются
+                await _store_call(store.delete_ids, new_ids)
+                return
+            # старые векторы изменённого файла заменяем новыми
+            await _store_call(store.delete_ids, old_ids)
+            state[rf.path] = rf.signature
+            added += 1
+            pending += 1
+        await checkpoint()
+
+    try:
+        async for rf, content, err in source.iter_contents(to_fetch, concurrency=download_concurrency,
+                                                           timeout=download_timeout, retries=download_retries):
+            step += 1
+            if progress_cb:
+                progress_cb(step, total, rf.path)
+            if err is not None:
+                logging.warning("[KB] download failed for %s: %s", rf.path, err)
+                continue
+            if state.get(rf.path) == YandexDiskClient.file_signature(content):
+                # старый формат состояния (md5 содержимого) — файл не менялся
+                state[rf.path] = rf.signature
+                continue
+            await checkpoint()
+            await slots.acquire()
+            task = asyncio.create_task(process(rf, content))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    await checkpoint(force=True)
     return added, total
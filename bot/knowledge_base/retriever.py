@@ -1,15 +1,319 @@
-from .embedder import Embedder
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+
+from .embedder import TextEmbedder
+from .postprocess import select_context
+from .query_batcher import QueryBatcher
+from .snapshots import IndexSnapshots
 from .vector_store import VectorStore
 
+SEARCH_MODES = ("hybrid", "vector", "keyword")
+
+
+class TTLCache:
+    """LRU-кэш с ограничением по числу записей и времени жизни; считает попадания и промахи."""
+    def __init__(self, max_size: int = 1024, ttl: float = 600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+def rrf_scores(rankings: List[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Reciprocal rank fusion: [(id, сумма 1 / (k + ранг) по всем спискам)] по убыванию."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, i in enumerate(ranking):
+            scores[i] = scores.get(i, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def rrf_fuse(rankings: List[List[int]], k: int = 60) -> List[int]:
+    return [i for i, _ in rrf_scores(rankings, k)]
+
+
+class _Pinned:
+    """Один неизменяемый индекс с интерфейсом IndexSnapshots.acquire()."""
+    def __init__(self, store: VectorStore):
+        self.store = store
+
+    @contextmanager
+    def acquire(self):
+        yield self.store
+
+
 class Retriever:
-    def __init__(self, embedder: Embedder, store: VectorStore, top_k: int = 6):
+    """
+    Поиск по базе знаний. Эмбеддинги запросов и top-k выдача кэшируются по
+    нормализованному запросу; ключ выдачи включает store.version, поэтому после
+    переиндексации старые результаты не используются.
+
+    mode: hybrid — векторный поиск и BM25 объединяются через RRF; vector — только
+    FAISS; keyword — только BM25, без сетевых запросов. Если API эмбеддингов
+    недоступно или отвечает дольше slow_embed секунд, следующие fallback_cooldown
+    секунд поиск идёт только по ключевым словам.
+
+    asearch() — асинхронный вариант для обработчиков бота: эмбеддинг через aembed,
+    FAISS и BM25 — в отдельном пуле потоков, поэтому цикл событий не блокируется,
+    а одновременные запросы выполняются параллельно. При batch_queries запросы,
+    пришедшие в пределах max_wait, объединяются QueryBatcher'ом в один запрос
+    эмбеддингов и один батчевый index.search.
+
+    context()/acontext() готовят контекст для промпта: соседние чанки одного файла
+    склеиваются без перекрытия, фрагменты упорядочиваются по MMR (релевантность —
+    косинус к запросу вместе с оценкой RRF, вес score_weight) и отбираются
+    в пределах token_budget.
+
+    store — VectorStore или IndexSnapshots. Каждый вызов поиска закрепляет один снимок
+    индекса на всё время выполнения: начатые запросы дорабатывают на старом снимке,
+    новые после публикации идут в новый. Если задачу отменили, пока поток пула ещё
+    ищет, снимок может закрыться раньше — такой поток завершится ошибкой, но его
+    результат уже никому не нужен.
+    """
+    def __init__(self, embedder: TextEmbedder, store: Union[VectorStore, IndexSnapshots], top_k: int = 6,
+                 cache_size: int = 1024, cache_ttl: float = 600.0, mode: str = "hybrid",
+                 candidates: int = 4, slow_embed: float = 5.0, fallback_cooldown: float = 60.0,
+                 search_workers: int = 4, batch_queries: bool = True, max_batch: int = 32, max_wait: float = 0.005,
+                 chunk_overlap: int = 50, mmr_lambda: float = 0.7, score_weight: float = 0.5,
+                 model: str = "gpt-4o-mini"):
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
         self.embedder = embedder
-        self.store = store
+        self.snapshots = store if isinstance(store, IndexSnapshots) else _Pinned(store)
         self.top_k = top_k
+        self.mode = mode
+        self.candidates = candidates
+        self.slow_embed = slow_embed
+        self.fallback_cooldown = fallback_cooldown
+        self.chunk_overlap = chunk_overlap
+        self.mmr_lambda = mmr_lambda
+        self.score_weight = score_weight
+        self.model = model
+        self.query_cache = TTLCache(cache_size, cache_ttl)
+        self.result_cache = TTLCache(cache_size, cache_ttl)
+        self._version = 0
+        self._embed_down_until = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="kb-search")
+        self.batcher = QueryBatcher(embedder, self._executor, max_batch, max_wait) if batch_queries else None
+
+    # ------------------------------------------------------------------
+    # Эмбеддинг запроса
+    # ------------------------------------------------------------------
+    def embed_query(self, query: str):
+        key = (self.embedder.model, normalize_query(query))
+        vec = self.query_cache.get(key)
+        if vec is None:
+            vec = self.embedder.embed([query])[0]
+            self.query_cache.put(key, vec)
+        return vec
+
+    async def aembed_query(self, query: str):
+        key = (self.embedder.model, normalize_query(query))
+        vec = self.query_cache.get(key)
+        if vec is None:
+            vec = (await self.embedder.aembed([query], urgent=True))[0]
+            self.query_cache.put(key, vec)
+        return vec
+
+    def _embed_failed(self, e: Exception):
+        logging.warning("[KB] query embedding failed, falling back to keyword search: %s", e)
+        self._embed_down_until = time.monotonic() + self.fallback_cooldown
+
+    def _try_embed(self, query: str):
+        """Эмбеддинг запроса или None, если API сейчас не используем."""
+        if time.monotonic() < self._embed_down_until:
+            return None
+        started = time.monotonic()
+        try:
+            vec = self.embed_query(query)
+        except Exception as e:
+            self._embed_failed(e)
+            return None
+        if time.monotonic() - started > self.slow_embed:
+            logging.warning("[KB] query embedding took %.1fs, keyword-only search for %.0fs",
+                            time.monotonic() - started, self.fallback_cooldown)
+            self._embed_down_until = time.monotonic() + self.fallback_cooldown
+        return vec
+
+    async def _embed_and_search(self, store: VectorStore, query: str, vec, fetch: int):
+        if vec is None:
+            vec = (await self.embedder.aembed([query], urgent=True))[0]
+        loop = asyncio.get_running_loop()
+        return vec, await loop.run_in_executor(self._executor, store.search_ids, vec, fetch)
+
+    async def _avector_ids(self, store: VectorStore, query: str, fetch: int, mode: str):
+        """(вектор запроса, id ближайших) или (None, []), если в hybrid API эмбеддингов сейчас не используем."""
+        if mode == "hybrid" and time.monotonic() < self._embed_down_until:
+            return None, []
+        key = (self.embedder.model, normalize_query(query))
+        vec = self.query_cache.get(key)
+        if self.batcher is not None:
+            work = self.batcher.search(store, query, vec, fetch)
+        else:
+            work = self._embed_and_search(store, query, vec, fetch)
+        if mode == "vector":
+            vec, hits = await work
+        else:
+            try:
+                # медленный запрос не ждём: отменяем и отвечаем по ключевым словам
+                vec, hits = await asyncio.wait_for(work, timeout=self.slow_embed)
+            except asyncio.TimeoutError:
+                self._embed_failed(TimeoutError(f"no response in {self.slow_embed:.1f}s"))
+                return None, []
+            except Exception as e:
+                self._embed_failed(e)
+                return None, []
+        self.query_cache.put(key, vec)
+        return vec, [i for i, _ in hits]
+
+    # ------------------------------------------------------------------
+    # Поиск
+    # ------------------------------------------------------------------
+    def _cache_key(self, store: VectorStore, query: str, k: int, mode: str):
+        version = store.version
+        if version > self._version:
+            # индекс изменился — старая выдача больше не нужна
+            # (версии сквозные, запросы к ещё не отпущенному старому снимку кэш не сбрасывают)
+            self.result_cache.clear()
+            self._version = version
+        return normalize_query(query), k, version, mode
+
+    def _fetch(self, k: int, mode: str) -> int:
+        return k * self.candidates if mode == "hybrid" else k
+
+    def _keyword_ids(self, store: VectorStore, query: str, fetch: int, mode: str) -> List[int]:
+        return [i for i, _ in store.keyword_search_ids(query, fetch)] if mode != "vector" else []
 
-    def search(self, query: str, top_k: int = None):
+    def _texts(self, store: VectorStore, vector: List[int], keyword: List[int], k: int) -> List[str]:
+        ids = rrf_fuse([vector, keyword])[:k] if vector and keyword else (vector or keyword)[:k]
+        meta = store.get_meta(ids)
+        # meta: (file, chunk_id, text, page)
+        return [meta[i][2] for i in ids if i in meta]
+
+    def _rank(self, store: VectorStore, query: str, vec, k: int, mode: str) -> List[str]:
+        fetch = self._fetch(k, mode)
+        vector = [i for i, _ in store.search_ids(vec, fetch)] if vec is not None else []
+        return self._texts(store, vector, self._keyword_ids(store, query, fetch, mode), k)
+
+    def _remember(self, key, texts: List[str], vec, mode: str):
+        if mode == "keyword" or vec is not None:
+            # выдачу аварийного режима не кэшируем: после восстановления API нужен полный поиск
+            self.result_cache.put(key, tuple(texts))
+
+    def search(self, query: str, top_k: int = None, mode: Optional[str] = None):
+        k = top_k or self.top_k
+        mode = mode or self.mode
+        with self.snapshots.acquire() as store:
+            key = self._cache_key(store, query, k, mode)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return list(cached)
+            if mode == "vector":
+                vec = self.embed_query(query)
+            else:
+                vec = self._try_embed(query) if mode == "hybrid" else None
+            texts = self._rank(store, query, vec, k, mode)
+        self._remember(key, texts, vec, mode)
+        return texts
+
+    async def asearch(self, query: str, top_k: int = None, mode: Optional[str] = None):
+        """Неблокирующий search(); отмена задачи прерывает ожидание эмбеддинга и поиска."""
         k = top_k or self.top_k
-        vec = self.embedder.embed([query])[0]
-        results = self.store.search(vec, k)
-        # results: [((file, chunk_id, text), dist), ...]
-        return [meta[2] for meta, _ in results]
+        mode = mode or self.mode
+        with self.snapshots.acquire() as store:
+            key = self._cache_key(store, query, k, mode)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return list(cached)
+            fetch = self._fetch(k, mode)
+            loop = asyncio.get_running_loop()
+            # BM25 считается в пуле, пока ждём эмбеддинг и FAISS
+            keyword = loop.run_in_executor(self._executor, self._keyword_ids, store, query, fetch, mode)
+            vec, vector = (None, []) if mode == "keyword" else await self._avector_ids(store, query, fetch, mode)
+            texts = await loop.run_in_executor(self._executor, self._texts, store, vector, await keyword, k)
+        self._remember(key, texts, vec, mode)
+        return texts
+
+    # ------------------------------------------------------------------
+    # Контекст для промпта
+    # ------------------------------------------------------------------
+    def _passages(self, store: VectorStore, vec, vector: List[int], keyword: List[int], token_budget: int) -> List[str]:
+        scored = rrf_scores([vector, keyword])
+        ids = [i for i, _ in scored]
+        meta = store.get_meta(ids)
+        vectors = store.vectors(ids) if vec is not None else None
+        if vectors is not None and vectors.shape[1] != len(vec):
+            # векторы из усечённого индекса — сравниваем с запросом в той же размерности
+            vec = store.prepare(vec)[0]
+        hits = [(meta[i], score, None if vectors is None else vectors[pos])
+                for pos, (i, score) in enumerate(scored) if i in meta]
+        passages = select_context(hits, vec, token_budget, self.chunk_overlap, self.mmr_lambda, self.model,
+                                  self.score_weight)
+        return [p.text for p in passages]
+
+    def context(self, query: str, token_budget: int = 3000, mode: Optional[str] = None) -> List[str]:
+        mode = mode or self.mode
+        fetch = self.top_k * self.candidates
+        if mode == "vector":
+            vec = self.embed_query(query)
+        else:
+            vec = self._try_embed(query) if mode == "hybrid" else None
+        with self.snapshots.acquire() as store:
+            vector = [i for i, _ in store.search_ids(vec, fetch)] if vec is not None else []
+            return self._passages(store, vec, vector, self._keyword_ids(store, query, fetch, mode), token_budget)
+
+    async def acontext(self, query: str, token_budget: int = 3000, mode: Optional[str] = None) -> List[str]:
+        mode = mode or self.mode
+        fetch = self.top_k * self.candidates
+        loop = asyncio.get_running_loop()
+        with self.snapshots.acquire() as store:
+            keyword = loop.run_in_executor(self._executor, self._keyword_ids, store, query, fetch, mode)
+            vec, vector = (None, []) if mode == "keyword" else await self._avector_ids(store, query, fetch, mode)
+            return await loop.run_in_executor(self._executor, self._passages, store, vec, vector,
+                                              await keyword, token_budget)
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {"query_embeddings": self.query_cache.stats(), "results": self.result_cache.stats()}
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
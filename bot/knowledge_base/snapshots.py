@@ -0,0 +1,215 @@
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .vector_store import VectorStore
+
+CURRENT = "CURRENT"
+INDEX_FILE = "index.faiss"
+STATE_FILE = "kb_state.json"
+_NAME = re.compile(r"^v(\d{6})$")
+
+
+def _snapshot_name(n: int) -> str:
+    return f"v{n:06d}"
+
+
+def _copy_sqlite(src: str, dst: str):
+    # backup API даёт согласованную копию даже при открытых соединениях
+    source, target = sqlite3.connect(src), sqlite3.connect(dst)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+class _Snapshot:
+    def __init__(self, name: str, store: VectorStore):
+        self.name = name
+        self.store = store
+        self.readers = 0
+        self.retired = False
+
+
+class IndexSnapshots:
+    """
+    Версионированные снимки индекса: base_dir/v000001/, v000002/, ... (index.faiss,
+    index.faiss.db, kb_state.json), имя опубликованного снимка — в base_dir/CURRENT.
+
+    Чтение по схеме read-copy-update: acquire() закрепляет текущий снимок за читателем
+    до конца блока with. Переиндексация пишет в новый снимок (prepare() копирует
+    текущий), publish() атомарно подменяет CURRENT и объект для новых читателей.
+    Прежний снимок закрывается и удаляется с диска, когда его покидает последний читатель.
+
+    open_store(path, read_only) открывает VectorStore: читатели получают снимок только
+    для чтения (индекс через mmap), prepare() — изменяемую копию в памяти.
+    """
+    def __init__(self, base_dir: str, open_store: Callable[..., VectorStore], legacy_index: Optional[str] = None,
+                 legacy_state: Optional[str] = None):
+        self.base_dir = base_dir
+        self.open_store = open_store
+        self._lock = threading.Lock()
+        os.makedirs(base_dir, exist_ok=True)
+        name = self._read_current()
+        if name is None:
+            name = self._create_first(legacy_index, legacy_state)
+        self._current = _Snapshot(name, open_store(self.index_path(name), read_only=True))
+        self._remove_stale()
+
+    # ------------------------------------------------------------------
+    # Пути
+    # ------------------------------------------------------------------
+    def path(self, name: str) -> str:
+        return os.path.join(self.base_dir, name)
+
+    def index_path(self, name: str) -> str:
+        return os.path.join(self.base_dir, name, INDEX_FILE)
+
+    def state_path(self, name: str) -> str:
+        return os.path.join(self.base_dir, name, STATE_FILE)
+
+    def _numbers(self) -> List[int]:
+        return sorted(int(m.group(1)) for m in map(_NAME.match, os.listdir(self.base_dir))
+                      if m and os.path.isdir(self.path(m.group(0))))
+
+    def _read_current(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.base_dir, CURRENT), "r", encoding="utf-8") as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return name if _NAME.match(name) and os.path.isdir(self.path(name)) else None
+
+    def _write_current(self, name: str):
+        path = os.path.join(self.base_dir, CURRENT)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _create_first(self, legacy_index: Optional[str], legacy_state: Optional[str]) -> str:
+        numbers = self._numbers()
+        name = _snapshot_name(numbers[-1] + 1 if numbers else 1)
+        os.makedirs(self.path(name))
+        # индекс в старом формате (один файл рядом с data/) переносим в первый снимок
+        if legacy_index and os.path.exists(legacy_index):
+            shutil.copyfile(legacy_index, self.index_path(name))
+            if os.path.exists(legacy_index + ".meta"):
+                shutil.copyfile(legacy_index + ".meta", self.index_path(name) + ".meta")
+            if os.path.exists(legacy_index + ".db"):
+                _copy_sqlite(legacy_index + ".db", self.index_path(name) + ".db")
+            if legacy_state and os.path.exists(legacy_state):
+                shutil.copyfile(legacy_state, self.state_path(name))
+            logging.info("[KB] migrated %s to snapshot %s", legacy_index, name)
+        self._write_current(name)
+        return name
+
+    def _remove_stale(self):
+        # опубликованные раньше снимки после перезапуска никому не нужны;
+        # более новые — незаконченная переиндексация, их оставляем для prepare()
+        current = int(_NAME.match(self._current.name).group(1))
+        for n in self._numbers():
+            if n < current:
+                shutil.rmtree(self.path(_snapshot_name(n)), ignore_errors=True)
+
+    # ------------------------------------------------------------------
+    # Читатели
+    # ------------------------------------------------------------------
+    @property
+    def current(self) -> str:
+        return self._current.name
+
+    @contextmanager
+    def acquire(self) -> Iterator[VectorStore]:
+        with self._lock:
+            snapshot = self._current
+            snapshot.readers += 1
+        try:
+            yield snapshot.store
+        finally:
+            with self._lock:
+                snapshot.readers -= 1
+                release = snapshot.retired and snapshot.readers == 0
+            if release:
+                self._release(snapshot)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"current": self._current.name, "readers": self._current.readers}
+
+    # ------------------------------------------------------------------
+    # Запись
+    # ------------------------------------------------------------------
+    def has_unfinished(self) -> bool:
+        """Есть ли неопубликованный снимок прерванной переиндексации."""
+        current = int(_NAME.match(self._current.name).group(1))
+        return any(n > current for n in self._numbers())
+
+    def prepare(self) -> Tuple[str, VectorStore]:
+        """
+        Снимок для переиндексации: незаконченный с прошлого раза (продолжение с контрольной
+        точки) или свежая копия текущего. Возвращает (имя, открытый VectorStore).
+        """
+        current = int(_NAME.match(self._current.name).group(1))
+        newer = [n for n in self._numbers() if n > current]
+        if newer:
+            name = _snapshot_name(newer[-1])
+            for n in newer[:-1]:
+                shutil.rmtree(self.path(_snapshot_name(n)), ignore_errors=True)
+            logging.info("[KB] resuming unfinished snapshot %s", name)
+        else:
+            name = _snapshot_name(current + 1)
+            self._copy(self._current.name, name)
+        return name, self.open_store(self.index_path(name), read_only=False)
+
+    def _copy(self, src: str, dst: str):
+        tmp = self.path(dst) + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        # текущий снимок после публикации не меняется — файлы можно копировать как есть
+        for filename in (INDEX_FILE, INDEX_FILE + ".vecs", INDEX_FILE + ".vecs.ids", STATE_FILE):
+            if os.path.exists(os.path.join(self.path(src), filename)):
+                shutil.copyfile(os.path.join(self.path(src), filename), os.path.join(tmp, filename))
+        if os.path.exists(self.index_path(src) + ".db"):
+            _copy_sqlite(self.index_path(src) + ".db", os.path.join(tmp, INDEX_FILE + ".db"))
+        os.replace(tmp, self.path(dst))
+
+    def publish(self, name: str, store: VectorStore):
+        """
+        Делает сохранённый снимок текущим: новые читатели получают его заново открытым
+        только для чтения (store закрывается), старый освобождается после выхода своих читателей.
+        """
+        reader = self.open_store(self.index_path(name), read_only=True)
+        store.close()
+        self._write_current(name)
+        with self._lock:
+            old, self._current = self._current, _Snapshot(name, reader)
+            old.retired = True
+            release = old.readers == 0
+        if release:
+            self._release(old)
+        logging.info("[KB] published index snapshot %s", name)
+
+    def discard(self, name: str, store: VectorStore):
+        """Удаляет подготовленный снимок без публикации (переиндексация ничего не изменила)."""
+        store.close()
+        shutil.rmtree(self.path(name), ignore_errors=True)
+        logging.info("[KB] discarded unchanged snapshot %s", name)
+
+    def _release(self, snapshot: _Snapshot):
+        snapshot.store.close()
+        shutil.rmtree(self.path(snapshot.name), ignore_errors=True)
+        logging.info("[KB] released index snapshot %s", snapshot.name)
+
+    def close(self):
+        with self._lock:
+            snapshot = self._current
+        snapshot.store.close()
@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import os
+from typing import AsyncIterator, Iterable, Iterator, Optional, Protocol, Tuple
+
+from .downloader import iter_fetched
+from .yandex_client import RemoteFile
+
+Fetched = Tuple[RemoteFile, Optional[bytes], Optional[Exception]]
+
+
+class DocumentSource(Protocol):
+    """
+    Откуда reindex() берёт документы: список файлов с подписью версии (RemoteFile.signature)
+    и их содержимое. Реализации: YandexDiskClient (WebDAV) и LocalSource (каталог на диске).
+    """
+    def iter_files(self, root_path: str) -> Iterator[RemoteFile]:
+        ...
+
+    def iter_contents(self, files: Iterable[RemoteFile], concurrency: int = 4, timeout: float = 120.0,
+                      retries: int = 3) -> AsyncIterator[Fetched]:
+        ...
+
+    async def aclose(self):
+        ...
+
+
+def _raise(e: OSError):
+    raise e
+
+
+def _skip(name: str) -> bool:
+    # скрытые, временные файлы офисных программ и недописанные копии
+    return name.startswith((".", "~$")) or name.endswith((".tmp", ".part", ".swp"))
+
+
+class LocalSource:
+    """
+    Документы из локального каталога. Подпись версии — размер и mtime (ns), поэтому
+    неизменившиеся файлы не читаются. fingerprint() — дешёвый отпечаток дерева для
+    ReindexJob.watch(): меняется при любом добавлении, удалении или изменении файла.
+
+    Недоступный каталог (не смонтирован, нет прав) — ошибка, а не пустой список:
+    иначе переиндексация удалила бы из индекса все его файлы.
+    """
+    def iter_files(self, root_path: str) -> Iterator[RemoteFile]:
+        if not os.path.isdir(root_path):
+            raise FileNotFoundError(f"Knowledge base directory not found: {root_path}")
+        for dirpath, dirnames, filenames in os.walk(root_path, onerror=_raise):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for name in sorted(filenames):
+                if _skip(name):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue  # удалили между listdir и stat
+                yield RemoteFile(path=path, size=st.st_size, modified=str(st.st_mtime_ns))
+
+    def fingerprint(self, root_path: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for rf in self.iter_files(root_path):
+            h.update(f"{rf.path}\0{rf.signature}\n".encode("utf-8", "surrogateescape"))
+        return h.hexdigest()
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def iter_contents(self, files: Iterable[RemoteFile], concurrency: int = 4, timeout: float = 120.0,
+                      retries: int = 3) -> AsyncIterator[Fetched]:
+        return iter_fetched(lambda rf: asyncio.to_thread(self._read, rf.path), files, concurrency)
+
+    async def aclose(self):
+        pass
@@ -1,35 +1,198 @@
-from typing import List
+import logging
+import threading
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
 import tiktoken
 
-def split_text(text: str, max_tokens: int = 500, overlap: int = 50, model: str="gpt-4o-mini") -> List[str]:
-    enc = tiktoken.encoding_for_model(model)
-    tokens = enc.encode(text)
-    chunks = []
+# ----------------------------------------------------------------------
+# Реестр токенизаторов
+# ----------------------------------------------------------------------
+_encoders: Dict[str, tiktoken.Encoding] = {}
+_token_bytes: Dict[str, np.ndarray] = {}
+_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def byte_encoder() -> tiktoken.Encoding:
+    """
+    Запасной токенизатор без файлов BPE: один токен — один байт UTF-8. Байтов не меньше,
+    чем токенов любой BPE-модели, поэтому лимиты по нему соблюдаются с запасом.
+    """
+    return tiktoken.Encoding(name="utf8_bytes", pat_str=r"\S+|\s+",
+                             mergeable_ranks={bytes([b]): b for b in range(256)}, special_tokens={})
+
+def _load_encoder(model: str) -> tiktoken.Encoding:
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # файлы BPE скачиваются при первом обращении; без сети и кэша (офлайн, KB_EMBEDDER=local) считаем байты
+        logging.warning("Tokenizer for %s unavailable, counting UTF-8 bytes instead: %s", model, e)
+        return byte_encoder()
+
+def get_encoder(model: str = "gpt-4o-mini") -> tiktoken.Encoding:
+    """Токенизатор модели; создаётся один раз на процесс."""
+    enc = _encoders.get(model)
+    if enc is None:
+        with _lock:
+            enc = _encoders.get(model)
+            if enc is None:
+                enc = _load_encoder(model)
+                _encoders[model] = enc
+    return enc
+
+def _token_byte_lengths(enc: tiktoken.Encoding) -> np.ndarray:
+    """Длина в байтах каждого токена словаря (0 для пропусков в нумерации)."""
+    table = _token_bytes.get(enc.name)
+    if table is None:
+        with _lock:
+            table = _token_bytes.get(enc.name)
+            if table is None:
+                table = np.zeros(enc.n_vocab, dtype=np.int64)
+                for t in range(enc.n_vocab):
+                    try:
+                        table[t] = len(enc.decode_single_token_bytes(t))
+                    except KeyError:
+                        pass
+                _token_bytes[enc.name] = table
+    return table
+
+def warm_up(models: Iterable[str] = ("gpt-4o-mini",)):
+    """Загружает токенизаторы и таблицы длин заранее, чтобы первый запрос не ждал."""
+    for model in models:
+        _token_byte_lengths(get_encoder(model))
+
+def token_char_offsets(enc: tiktoken.Encoding, text: str, tokens: List[int]) -> np.ndarray:
+    """
+    Символьные смещения начала каждого токена в text плюс len(text) в конце.
+    Считается векторно по байтам UTF-8, без декодирования токенов.
+    """
+    lengths = _token_byte_lengths(enc)[np.asarray(tokens, dtype=np.int64)]
+    byte_starts = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=byte_starts[1:])
+    raw = np.frombuffer(text.encode("utf-8", errors="surrogatepass"), dtype=np.uint8)
+    is_start = (raw & 0xC0) != 0x80
+    chars_before = np.zeros(len(raw) + 1, dtype=np.int64)
+    np.cumsum(is_start, out=chars_before[1:])
+    offsets = chars_before[byte_starts]
+    # токен, начавшийся в середине символа, относим к этому символу
+    offsets[:-1] -= ~is_start[byte_starts[:-1]]
+    return offsets
+
+# ----------------------------------------------------------------------
+# Нарезка на чанки
+# ----------------------------------------------------------------------
+def chunk_spans(n_tokens: int, max_tokens: int = 500, overlap: int = 50) -> List[Tuple[int, int]]:
+    """Границы чанков в токенах: окно max_tokens с шагом max_tokens - overlap."""
+    step = max(1, max_tokens - overlap)
+    spans = []
     start = 0
-    while start < len(tokens):
-        end = min(start + max_tokens, len(tokens))
-        chunk = enc.decode(tokens[start:end])
-        chunks.append(chunk)
-        start = end - overlap
-        if start < 0:
-            start = 0
-    return chunks
+    while start < n_tokens:
+        end = min(start + max_tokens, n_tokens)
+        spans.append((start, end))
+        if end == n_tokens:
+            break
+        start += step
+    return spans
+
+def chunk_texts(texts: List[str], max_tokens: int = 500, overlap: int = 50, model: str="gpt-4o-mini") -> List[List[str]]:
+    """
+    Режет сразу несколько документов: токенизация одним encode_ordinary_batch,
+    чанки вырезаются из исходного текста по символьным смещениям токенов.
+    """
+    enc = get_encoder(model)
+    out = []
+    for text, tokens in zip(texts, enc.encode_ordinary_batch(texts)):
+        offsets = token_char_offsets(enc, text, tokens)
+        out.append([text[offsets[a]:offsets[b]] for a, b in chunk_spans(len(tokens), max_tokens, overlap)])
+    return out
+
+def iter_chunks(pages: Iterable[Tuple[int, str]], max_tokens: int = 500, overlap: int = 50,
+                model: str="gpt-4o-mini", page_batch: int = 16) -> Iterator[Tuple[int, str]]:
+    """
+    Скользящее окно по токенам поверх потока страниц: (номер страницы, текст) -> (страница, чанк).
+    В памяти держится только окно текущего чанка, страница чанка — страница его первого токена.
+    Страницы токенизируются пачками по page_batch.
+    """
+    enc = get_encoder(model)
+    step = max(1, max_tokens - overlap)
+    window = ""
+    offsets = np.zeros(1, dtype=np.int64)  # начала токенов окна + конец окна
+    token_pages = np.zeros(0, dtype=np.int64)
+    start = 0  # первый токен следующего чанка; начало окна до него отрезается раз на страницу
+    fresh = 0  # токены окна, ещё не попавшие ни в один чанк
+    pages = ((page, text) for page, text in pages if text)
+    while True:
+        group = list(islice(pages, page_batch))
+        if not group:
+            break
+        texts = [text if not window and i == 0 else "\n" + text for i, (_, text) in enumerate(group)]
+        for (page, _), text, tokens in zip(group, texts, enc.encode_ordinary_batch(texts)):
+            if start:
+                cut = offsets[start]
+                window = window[cut:]
+                offsets = offsets[start:] - cut
+                token_pages = token_pages[start:]
+                start = 0
+            offsets = np.concatenate((offsets[:-1], token_char_offsets(enc, text, tokens) + len(window)))
+            token_pages = np.concatenate((token_pages, np.full(len(tokens), page, dtype=np.int64)))
+            window += text
+            fresh += len(tokens)
+            # срезы по смещениям без копирования окна: большая страница режется за линейное время
+            while len(token_pages) - start >= max_tokens:
+                yield int(token_pages[start]), window[offsets[start]:offsets[start + max_tokens]]
+                start += step
+                fresh = len(token_pages) - start - (max_tokens - step)
+    if fresh > 0 and len(token_pages) > start:
+        yield int(token_pages[start]), window[offsets[start]:]
+
+def split_text(text: str, max_tokens: int = 500, overlap: int = 50, model: str="gpt-4o-mini") -> List[str]:
+    return chunk_texts([text], max_tokens=max_tokens, overlap=overlap, model=model)[0]
+
+# ----------------------------------------------------------------------
+# Подсчёт токенов истории
+# ----------------------------------------------------------------------
+@lru_cache(maxsize=8192)
+def _text_tokens(model: str, text: str) -> int:
+    return len(get_encoder(model).encode_ordinary(text))
+
+def message_tokens(message: dict, model: str = "gpt-4o-mini") -> int:
+    """
+    Токены content одного сообщения. Счётчик кэшируется по тексту: сами dict'ы
+    уходят в API как есть, поэтому служебных ключей в них не добавляем.
+    """
+    content = message.get("content") or ""
+    if not isinstance(content, str):
+        # мультимодальное сообщение: считаем только текстовые части
+        content = "\n".join(p.get("text", "") for p in content if isinstance(p, dict))
+    return _text_tokens(model, content)
 
 def num_tokens(messages, model="gpt-4o-mini"):
-    enc = tiktoken.encoding_for_model(model)
-    total = 0
-    for m in messages:
-        total += len(enc.encode(m.get("content","")))
-    return total
+    return sum(message_tokens(m, model) for m in messages)
 
 def trim_to_token_limit(messages, max_tokens: int, model="gpt-4o-mini"):
-    enc = tiktoken.encoding_for_model(model)
-    while num_tokens(messages, model) > max_tokens and len(messages) > 1:
-        # удаляем самое старое пользовательское/ассистентское сообщение (оставляем system)
-        for i, m in enumerate(messages):
-            if m["role"] != "system":
-                del messages[i]
-                break
+    """
+    Удаляет самые старые не-system сообщения, пока история не влезет в max_tokens.
+    Каждое сообщение считается один раз, удаление — за один проход; список меняется на месте.
+    """
+    counts = [message_tokens(m, model) for m in messages]
+    total = sum(counts)
+    if total <= max_tokens:
+        return messages
+    left = len(messages)
+    drop = set()
+    for i, m in enumerate(messages):
+        if total <= max_tokens or left <= 1:
+            break
+        # system-сообщения оставляем
+        if m["role"] != "system":
+            drop.add(i)
+            total -= counts[i]
+            left -= 1
+    messages[:] = [m for i, m in enumerate(messages) if i not in drop]
     return messages
 
 def build_context_messages(chunks: List[str]) -> List[dict]:
@@ -1,37 +1,594 @@
-import os, pickle
+import os, pickle, logging, math, itertools
+from typing import Dict, List, Optional, Set, Tuple
 import numpy as np
 import faiss
+from .meta_store import MetaStore
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+QUANTIZATIONS = ("none", "fp16", "int8")
+_SQ_TYPES = {"fp16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+COMPONENT_BYTES = {"none": 4, "fp16": 2, "int8": 1}
+
+# общий счётчик: версии разных экземпляров (снимков) не совпадают
+_versions = itertools.count(1)
+
+
+def _id_selector(ids) -> Tuple[faiss.IDSelector, np.ndarray]:
+    # массив нужно держать живым, пока используется селектор
+    arr = np.ascontiguousarray(ids, dtype="int64")
+    return faiss.IDSelectorArray(len(arr), faiss.swig_ptr(arr)), arr
+
+
+def _pq_m(dim: int) -> int:
+    """Число подвекторов PQ: ~32 измерения на подвектор, делитель dim."""
+    m = max(1, dim // 32)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def needs_training(kind: str, quantization: str = "none") -> bool:
+    return kind.startswith("ivf") or quantization == "int8"
+
+
+def truncate_vectors(vectors: np.ndarray, dim: int) -> np.ndarray:
+    """Первые dim компонент с повторной L2-нормировкой (Matryoshka-эмбеддинги text-embedding-3)."""
+    if vectors.shape[1] == dim:
+        return vectors
+    head = np.ascontiguousarray(vectors[:, :dim])
+    return head / np.maximum(np.linalg.norm(head, axis=1, keepdims=True), 1e-12)
+
+
+def build_index(kind: str, dim: int, train_vectors: Optional[np.ndarray] = None, nlist: Optional[int] = None,
+                pq_m: Optional[int] = None, hnsw_m: int = 32, quantization: str = "none") -> faiss.Index:
+    """
+    Создаёт пустой индекс с поддержкой пользовательских id (IVF-индексы и int8 обучаются
+    на train_vectors). quantization: none | fp16 | int8 — скалярное квантование
+    хранимых векторов; для ivf_pq не применяется (он и так сжимает).
+    """
+    qtype = _SQ_TYPES.get(quantization)
+    if kind == "flat":
+        if qtype is None:
+            return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        sq = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        if not sq.is_trained:
+            sq.train(train_vectors)
+        return faiss.IndexIDMap2(sq)
+    if kind == "hnsw":
+        if qtype is None:
+            return faiss.IndexIDMap2(faiss.IndexHNSWFlat(dim, hnsw_m))
+        hnsw = faiss.IndexHNSWSQ(dim, qtype, hnsw_m)
+        if not hnsw.is_trained:
+            hnsw.train(train_vectors)
+        return faiss.IndexIDMap2(hnsw)
+    if kind in ("ivf_flat", "ivf_pq"):
+        n = len(train_vectors)
+        nlist = nlist or max(1, min(int(4 * math.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatL2(dim)
+        if kind == "ivf_flat" and qtype is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype)
+        elif kind == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m or _pq_m(dim), 8)
+        index.train(train_vectors)
+        # IVF хранит id сам; hashtable позволяет reconstruct/remove по id
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+    raise ValueError(f"Unknown index type: {kind}")
+
+
+def read_index(path: str, mmap: bool = False) -> faiss.Index:
+    """
+    mmap=True: коды векторов отображаются из файла (IO_FLAG_MMAP_IFC), и ОС подгружает
+    их по мере обращения — RSS почти не зависит от размера индекса. Такой индекс только
+    для чтения: add/remove на нём аварийно завершают процесс (assert внутри faiss).
+    IO_FLAG_MMAP без _IFC плоские и SQ-коды всё равно копирует в память.
+    """
+    if mmap:
+        for flag in ("IO_FLAG_MMAP_IFC", "IO_FLAG_MMAP"):
+            if not hasattr(faiss, flag):
+                continue  # IO_FLAG_MMAP_IFC появился в faiss 1.10
+            try:
+                return faiss.read_index(path, getattr(faiss, flag))
+            except RuntimeError:
+                continue  # тип индекса не поддерживает этот режим
+    return faiss.read_index(path)
+
+
+def write_index(index: faiss.Index, path: str):
+    # пишем во временный файл и подменяем: открытый через mmap старый файл не портится
+    tmp = path + ".tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, path)
+
+
+class FullVectors:
+    """
+    Исходные float32-векторы на диске: строки подряд в path (".vecs"), id строк по
+    возрастанию — в path + ".ids" (int64). Строка ищется бинарным поиском по id и
+    читается точечно через pread; в памяти только массив id (8 байт на вектор).
+    Нужны для точного пересчёта расстояний и перестроения индекса без потерь.
+
+    compact(live_ids) переписывает оба файла, оставляя только живые строки, — иначе
+    векторы удалённых и переиндексированных файлов копились бы бесконечно.
+    """
+    def __init__(self, path: str, dim: int, read_only: bool = False):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.read_only = read_only
+        self._open()
+
+    def _finish_compaction(self):
+        # .ids.new появляется, когда оба новых файла дописаны: подмену доводим до конца
+        if os.path.exists(self.path + ".ids.new"):
+            if os.path.exists(self.path + ".tmp"):
+                os.replace(self.path + ".tmp", self.path)
+            os.replace(self.path + ".ids.new", self.path + ".ids")
+
+    def _open(self):
+        if not self.read_only:
+            self._finish_compaction()
+        flags = os.O_RDONLY if self.read_only else os.O_RDWR | os.O_CREAT
+        self._fd = os.open(self.path, flags, 0o644)
+        rows = os.fstat(self._fd).st_size // self.row_bytes
+        if os.path.exists(self.path + ".ids"):
+            ids = np.fromfile(self.path + ".ids", dtype="int64")
+        else:
+            # прежний формат: строка id лежала по смещению id * dim * 4
+            ids = np.arange(rows, dtype="int64")
+            if not self.read_only:
+                ids.tofile(self.path + ".ids")
+        # строки без id (или id без строки) — недописанный хвост после сбоя
+        self.rows = min(rows, len(ids))
+        self._ids = ids[:self.rows]
+        self._pending: List[np.ndarray] = []
+        self._ids_fd = None if self.read_only else os.open(self.path + ".ids", os.O_RDWR | os.O_CREAT, 0o644)
+
+    def ids(self) -> np.ndarray:
+        if self._pending:
+            self._ids = np.concatenate([self._ids] + self._pending)
+            self._pending = []
+        return self._ids
+
+    def _truncate(self, rows: int):
+        self._ids = self.ids()[:rows]
+        self.rows = rows
+        os.ftruncate(self._fd, rows * self.row_bytes)
+        os.ftruncate(self._ids_fd, rows * 8)
+
+    def write(self, first_id: int, vectors: np.ndarray):
+        # id в add() идут подряд и растут — строки дописываются в конец, порядок id сохраняется
+        if self.rows and self.ids()[-1] >= first_id:
+            # хвост от прогона, не дошедшего до save(): эти id выдаются заново
+            self._truncate(int(np.searchsorted(self.ids(), first_id)))
+        data = np.ascontiguousarray(vectors, dtype="float32").tobytes()
+        ids = np.arange(first_id, first_id + len(vectors), dtype="int64")
+        os.pwrite(self._fd, data, self.rows * self.row_bytes)
+        os.pwrite(self._ids_fd, ids.tobytes(), self.rows * 8)
+        self._pending.append(ids)
+        self.rows += len(ids)
+
+    def read(self, ids) -> Optional[np.ndarray]:
+        """Векторы по id или None, если каких-то строк нет (индекс собран до включения)."""
+        known = self.ids()
+        ids = np.asarray(ids, dtype="int64")
+        pos = np.searchsorted(known, ids)
+        if len(ids) and (pos.max() >= len(known) or (known[pos] != ids).any()):
+            return None
+        out = np.empty((len(ids), self.dim), dtype="float32")
+        for row, p in enumerate(pos):
+            out[row] = np.frombuffer(os.pread(self._fd, self.row_bytes, int(p) * self.row_bytes), dtype="float32")
+        return out
+
+    def compact(self, live_ids, block: int = 4096):
+        """Оставляет только строки live_ids: запись во временные файлы и атомарная подмена."""
+        keep = np.isin(self.ids(), np.asarray(live_ids, dtype="int64"))
+        if keep.all():
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            for start in range(0, self.rows, block):
+                mask = keep[start:start + block]
+                if not mask.any():
+                    continue
+                data = os.pread(self._fd, len(mask) * self.row_bytes, start * self.row_bytes)
+                f.write(np.frombuffer(data, dtype="float32").reshape(-1, self.dim)[mask].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.path + ".ids.tmp", "wb") as f:
+            f.write(self._ids[keep].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(self.path + ".ids.tmp", self.path + ".ids.new")
+        self._open()  # подменяет строки и id
+
+    def sync(self):
+        os.fsync(self._fd)
+        os.fsync(self._ids_fd)
+
+    def close(self):
+        for fd in (self._fd, self._ids_fd):
+            if fd is not None:
+                os.close(fd)
+        self._fd = self._ids_fd = None
+
 
 class VectorStore:
-    def __init__(self, dim: int, path: str = "data/index.faiss"):
+    """
+    FAISS-индекс со стабильными id чанков; метаданные и тексты — в MetaStore (path + ".db").
+    Удаление файла помечает его id как tombstones: они сразу исключаются из выдачи,
+    а физически удаляются из индекса в compact().
+
+    index_type: flat | hnsw | ivf_flat | ivf_pq. IVF-индексы требуют обучения:
+    пока векторов меньше min_train, данные копятся в плоском индексе, затем
+    индекс обучается и перестраивается автоматически.
+
+    Сжатие: quantization (fp16 | int8, int8 обучается так же, как IVF) и truncate_dim —
+    в индекс кладутся первые truncate_dim компонент эмбеддинга. При rescore > 0
+    исходные векторы хранятся на диске (FullVectors), из индекса берётся k * rescore
+    кандидатов, и они переранжируются по точному расстоянию.
+
+    version увеличивается при любом изменении (add/delete/compact/load) и уникальна
+    среди всех экземпляров — по ней кэши выдачи понимают, что индекс обновился.
+
+    read_only=True — для опубликованных снимков: индекс открывается через mmap
+    (read_index), а add/delete/compact/save запрещены.
+    """
+    def __init__(self, dim: int, path: str = "data/index.faiss", compact_ratio: float = 0.2,
+                 index_type: str = "flat", nlist: Optional[int] = None, pq_m: Optional[int] = None,
+                 hnsw_m: int = 32, nprobe: int = 16, ef_search: int = 64, min_train: int = 10000,
+                 quantization: str = "none", truncate_dim: Optional[int] = None, rescore: int = 0,
+                 read_only: bool = False):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {index_type}")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}")
         self.dim = dim
+        self.index_dim = min(truncate_dim or dim, dim)  # размерность векторов в индексе
+        self.quantization = quantization
+        self.rescore = rescore
+        self.read_only = read_only
         self.path = path
-        self.index = faiss.IndexFlatL2(dim)
-        self.meta = []
-        if os.path.exists(path) and os.path.exists(path + ".meta"):
+        self.compact_ratio = compact_ratio
+        self.index_type = index_type
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.min_train = min_train
+        # фактические тип и квантование индекса (до обучения — плоский float32)
+        if needs_training(index_type, quantization):
+            self.kind, self.sq = "flat", "none"
+        else:
+            self.kind, self.sq = index_type, quantization
+        self.index = build_index(self.kind, self.index_dim, hnsw_m=hnsw_m, quantization=self.sq)
+        self.db = MetaStore(path + ".db")
+        vecs = path + ".vecs"
+        self.full = (FullVectors(vecs, dim, read_only)
+                     if os.path.exists(vecs) or (rescore and not read_only) else None)
+        self.tombstones: Set[int] = set()
+        self.next_id = 0
+        self.version = next(_versions)  # растёт при каждом изменении содержимого индекса
+        self._filter = None  # кэш _tombstone_filter()
+        self._apply_search_params()
+        if os.path.exists(path):
             self.load()
 
-    def add(self, vectors: list[list[float]], meta_batch: list[tuple]):
-        self.index.add(np.array(vectors, dtype="float32"))
-        self.meta.extend(meta_batch)
+    @property
+    def ntotal(self) -> int:
+        """Число живых векторов (без tombstones)."""
+        return self.index.ntotal - len(self.tombstones)
+
+    def _apply_search_params(self):
+        if self.kind == "hnsw":
+            faiss.downcast_index(self.index.index).hnsw.efSearch = self.ef_search
+        elif self.kind.startswith("ivf"):
+            faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+
+    def prepare(self, vectors) -> np.ndarray:
+        """Векторы эмбеддингов (n, dim) -> векторы в пространстве индекса (усечённые)."""
+        vectors = np.asarray(vectors, dtype="float32").reshape(-1, self.dim)
+        return truncate_vectors(vectors, self.index.d)
+
+    def live_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (ids, vectors) живых чанков в пространстве индекса. Из FullVectors — без потерь,
+        иначе reconstruct (для ivf_pq и квантованных индексов — приближённо).
+        """
+        ids = np.fromiter(self.db.live_ids(), dtype="int64")
+        if not len(ids):
+            return ids, np.zeros((0, self.index_dim), dtype="float32")
+        full = self.full.read(ids) if self.full is not None else None
+        if full is not None:
+            return ids, truncate_vectors(full, self.index_dim)
+        return ids, truncate_vectors(self.index.reconstruct_batch(ids), self.index_dim)
+
+    def _rebuild(self, kind: str, sq: str):
+        ids, vectors = self.live_vectors()
+        index = build_index(kind, self.index_dim, vectors, nlist=self.nlist, pq_m=self.pq_m, hnsw_m=self.hnsw_m,
+                            quantization=sq)
+        if len(ids):
+            index.add_with_ids(vectors, ids)
+        self.index = index
+        self.kind, self.sq = kind, sq
+        self.tombstones.clear()
+        if not self.read_only:
+            # в файле снимка только для чтения tombstones остаются — индекс на диске прежний
+            self.db.clear_tombstones()
+            if self.full is not None:
+                self.full.compact(ids)
+        self._apply_search_params()
+
+    def _maybe_train(self):
+        pending = (self.kind, self.sq) == ("flat", "none") and needs_training(self.index_type, self.quantization)
+        if pending and self.ntotal >= self.min_train:
+            logging.info("[KB] training %s/%s index on %d vectors", self.index_type, self.quantization, self.ntotal)
+            self._rebuild(self.index_type, self.quantization)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"{self.path} is opened read-only")
+
+    def add(self, vectors: list[list[float]], meta_batch: list[tuple]) -> List[int]:
+        self._check_writable()
+        ids = list(range(self.next_id, self.next_id + len(meta_batch)))
+        full = np.asarray(vectors, dtype="float32").reshape(-1, self.dim)
+        if self.full is not None:
+            self.full.write(self.next_id, full)
+        self.next_id += len(ids)
+        self.index.add_with_ids(self.prepare(full), np.array(ids, dtype="int64"))
+        # meta: (file, chunk_no, text[, page])
+        self.db.add((i, m[0], m[1], m[2], m[3] if len(m) > 3 else None) for i, m in zip(ids, meta_batch))
+        self._maybe_train()
+        self.version = next(_versions)
+        return ids
+
+    def file_ids(self, file: str) -> List[int]:
+        return self.db.ids_for_file(file)
+
+    def delete_file(self, file: str) -> int:
+        self._check_writable()
+        ids = self.db.delete_file(file)
+        self.tombstones.update(ids)
+        self.db.add_tombstones(ids)
+        if ids:
+            self.version = next(_versions)
+        return len(ids)
+
+    def delete_ids(self, ids: List[int]) -> int:
+        self._check_writable()
+        self.db.delete_ids(ids)
+        self.tombstones.update(ids)
+        self.db.add_tombstones(ids)
+        if ids:
+            self.version = next(_versions)
+        return len(ids)
+
+    def compact(self):
+        if not self.tombstones:
+            return
+        self._check_writable()
+        self.version = next(_versions)
+        if self.kind == "hnsw":
+            # HNSW не умеет удалять — перестраиваем из живых векторов
+            self._rebuild("hnsw", self.sq)
+            return
+        selector, _ids = _id_selector(sorted(self.tombstones))
+        self.index.remove_ids(selector)
+        self.tombstones.clear()
+        self.db.clear_tombstones()
+        if self.full is not None:
+            self.full.compact(np.fromiter(self.db.live_ids(), dtype="int64"))
+
+    def maybe_compact(self):
+        if self.tombstones and len(self.tombstones) >= self.compact_ratio * self.index.ntotal:
+            self.compact()
+
+    def search_ids_batch(self, vectors, k: int = 5, rescore: Optional[int] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Один index.search по матрице (n, dim): для каждой строки [(id, distance)] живых чанков.
+        rescore переопределяет self.rescore (0 — без пересчёта).
+        """
+        queries = np.asarray(vectors, dtype="float32").reshape(-1, self.dim)
+        if self.ntotal <= 0 or not len(queries):
+            return [[] for _ in range(len(queries))]
+        rescore = self.rescore if rescore is None else rescore
+        want = min(k * rescore if rescore and self.full is not None else k, self.index.ntotal)
+        tombstone_filter = self._tombstone_filter()  # ссылка держит селекторы живыми на время поиска
+        params = tombstone_filter[1] if tombstone_filter else None
+        D, I = self.index.search(self.prepare(queries), want, params=params)
+        out = []
+        for query, row_d, row_i in zip(queries, D, I):
+            hits = [(int(idx), float(dist)) for dist, idx in zip(row_d, row_i) if idx != -1]
+            out.append(self._rescore(query, hits)[:k] if want > k else hits)
+        return out
+
+    def _tombstone_filter(self):
+        """
+        (ключ, SearchParameters, селекторы) с фильтром tombstones внутри FAISS (IDSelectorNot):
+        индекс не запрашивает лишних соседей, сколько бы удалённых id ни ждало compact().
+        Собирается раз на версию; кортеж заменяется целиком — параллельные поиски
+        в потоках продолжают пользоваться своим.
+        """
+        if not self.tombstones:
+            return None
+        key = (self.version, self.kind)
+        cached = self._filter
+        if cached is None or cached[0] != key:
+            ids = np.fromiter(self.tombstones, dtype="int64", count=len(self.tombstones))
+            batch = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))  # копирует id в себя
+            sel = faiss.IDSelectorNot(batch)
+            if self.kind == "hnsw":
+                params = faiss.SearchParametersHNSW(sel=sel, efSearch=self.ef_search)
+            elif self.kind.startswith("ivf"):
+                params = faiss.SearchParametersIVF(sel=sel, nprobe=self.nprobe)
+            else:
+                params = faiss.SearchParameters(sel=sel)
+            cached = self._filter = (key, params, batch, sel)
+        return cached
+
+    def _rescore(self, query: np.ndarray, hits: List[Tuple[int, float]]) -> List[Tuple[int, float]]:
+        """Переранжирование кандидатов по точному L2 на исходных векторах."""
+        full = self.full.read([i for i, _ in hits]) if hits else None
+        if full is None:
+            return hits
+        dist = ((full - query) ** 2).sum(axis=1)
+        return [(hits[j][0], float(dist[j])) for j in np.argsort(dist)]
+
+    def search_ids(self, vector: list[float], k: int = 5) -> List[Tuple[int, float]]:
+        """[(id, distance)] ближайших живых чанков."""
+        return self.search_ids_batch([vector], k)[0]
+
+    def keyword_search_ids(self, query: str, k: int = 5) -> List[Tuple[int, float]]:
+        """[(id, bm25)] по полнотекстовому индексу; сеть и эмбеддинги не нужны."""
+        return self.db.keyword_search(query, k)
+
+    def get_meta(self, ids: List[int]):
+        return self.db.get(ids)
+
+    def vectors(self, ids: List[int]) -> Optional[np.ndarray]:
+        """
+        Векторы чанков по id: исходные из FullVectors, иначе из индекса (в его размерности,
+        для сжатых — приближённые); None, если индекс не умеет reconstruct.
+        """
+        if not ids:
+            return np.zeros((0, self.dim), dtype="float32")
+        full = self.full.read(ids) if self.full is not None else None
+        if full is not None:
+            return full
+        try:
+            return self.index.reconstruct_batch(np.asarray(ids, dtype="int64"))
+        except RuntimeError:
+            return None
 
     def search(self, vector: list[float], k: int = 5):
-        if self.index.ntotal == 0:
-            return []
-        D, I = self.index.search(np.array([vector], dtype="float32"), k)
-        results = []
-        for pos, idx in enumerate(I[0]):
-            if idx == -1: 
-                continue
-            results.append((self.meta[idx], float(D[0][pos])))
-        return results
+        hits = self.search_ids(vector, k)
+        # тексты читаем только для top-k
+        meta = self.db.get([i for i, _ in hits])
+        return [(meta[i], dist) for i, dist in hits if i in meta]
+
+    def memory_stats(self) -> Dict[str, int]:
+        """Оценка памяти под векторы индекса в сравнении с float32 полной размерности."""
+        n = self.index.ntotal
+        if self.kind == "ivf_pq":
+            per_vector = self.pq_m or _pq_m(self.index_dim)
+        else:
+            per_vector = COMPONENT_BYTES[self.sq] * self.index.d
+        return {"vectors": n, "index_bytes": n * per_vector, "float32_bytes": n * self.dim * 4}
+
+    def recall_at_k(self, k: int = 10, queries: int = 50, max_vectors: int = 200000) -> Optional[Dict[str, float]]:
+        """
+        recall@k поиска относительно точного поиска по исходным векторам (запросы —
+        случайные чанки индекса). None без FullVectors или если векторов больше max_vectors.
+        """
+        ids = np.fromiter(self.db.live_ids(), dtype="int64")
+        if self.full is None or not len(ids) or len(ids) > max_vectors:
+            return None
+        rng = np.random.default_rng(0)
+        q = self.full.read(ids[rng.choice(len(ids), size=min(queries, len(ids)), replace=False)])
+        if q is None:
+            return None
+        k = min(k, len(ids))
+        # точный top-k блоками, чтобы не читать все исходные векторы в память разом
+        best_d = np.full((len(q), k), np.inf, dtype="float32")
+        best_i = np.full((len(q), k), -1, dtype="int64")
+        for start in range(0, len(ids), 4096):
+            block_ids = ids[start:start + 4096]
+            block = self.full.read(block_ids)
+            if block is None:
+                return None
+            d = (q ** 2).sum(1)[:, None] - 2 * q @ block.T + (block ** 2).sum(1)[None, :]
+            cand_d = np.hstack([best_d, d])
+            cand_i = np.hstack([best_i, np.broadcast_to(block_ids, d.shape)])
+            top = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+            best_d = np.take_along_axis(cand_d, top, axis=1)
+            best_i = np.take_along_axis(cand_i, top, axis=1)
+        result = {}
+        for name, rescore in (("recall", None), ("recall_no_rescore", 0)):
+            found = self.search_ids_batch(q, k, rescore=rescore)
+            hits = sum(len(set(t) & {i for i, _ in f}) for t, f in zip(best_i.tolist(), found))
+            result[name] = round(hits / (len(q) * k), 4)
+        return result
 
     def save(self):
-        faiss.write_index(self.index, self.path)
-        with open(self.path + ".meta", "wb") as f:
-            pickle.dump(self.meta, f)
+        self._check_writable()
+        # сначала метаданные и исходные векторы: индекс никогда не содержит векторов без записи в БД
+        if self.full is not None:
+            self.full.sync()
+        self.db.set_value("next_id", self.next_id)
+        self.db.set_value("dim", self.dim)
+        self.db.set_value("index_type", self.kind)
+        self.db.set_value("quantization", self.sq)
+        self.db.commit()
+        write_index(self.index, self.path)
+
+    def close(self):
+        """Освобождает индекс (в т.ч. mmap) и соединение с БД; дальше экземпляр не используется."""
+        self.index = None
+        if self.full is not None:
+            self.full.close()
+        self.db.close()
 
     def load(self):
-        self.index = faiss.read_index(self.path)
-        with open(self.path + ".meta", "rb") as f:
-            self.meta = pickle.load(f)
+        stored_dim = int(self.db.get_value("dim", "0"))
+        if stored_dim and stored_dim != self.dim:
+            # другая модель эмбеддингов: усечение или смешивание векторов дали бы мусор
+            raise ValueError(f"{self.path} holds {stored_dim}-dim embeddings, expected {self.dim}; "
+                             f"use a separate index directory for another embedding model")
+        self.index = read_index(self.path, mmap=self.read_only)
+        if os.path.exists(self.path + ".meta"):
+            self._migrate_pickle(self.path + ".meta")
+        self.tombstones = set(self.db.tombstones())
+        self.next_id = int(self.db.get_value("next_id", "0"))
+        self.kind = self.db.get_value("index_type", "flat")
+        self.sq = self.db.get_value("quantization", "none")
+        self._apply_search_params()
+        self._convert_if_needed()
+        self.version = next(_versions)
+
+    def _migrate_pickle(self, meta_path: str):
+        """Переносит метаданные из старого pickle-формата в MetaStore."""
+        with open(meta_path, "rb") as f:
+            data = pickle.load(f)
+        if isinstance(data, list):
+            # самый старый формат: IndexFlatL2 + список meta по позициям
+            index = faiss.read_index(self.path)
+            vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, self.dim), dtype="float32")
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+            self.index.add_with_ids(vectors, np.arange(len(data), dtype="int64"))
+            meta, tombstones, next_id, kind = dict(enumerate(data)), set(), len(data), "flat"
+        else:
+            meta, tombstones = data["meta"], data["tombstones"]
+            next_id, kind = data["next_id"], data.get("index_type", "flat")
+        self.db.add((i, m[0], m[1], m[2], None) for i, m in meta.items())
+        self.db.add_tombstones(tombstones)
+        self.db.set_value("next_id", next_id)
+        self.db.set_value("index_type", kind)
+        self.db.commit()
+        write_index(self.index, self.path)
+        os.replace(meta_path, meta_path + ".migrated")
+        logging.info("[KB] migrated %d chunks from %s to %s", len(meta), meta_path, self.db.path)
+
+    def _convert_if_needed(self):
+        target = (self.index_type, self.quantization)
+        pending = (self.kind, self.sq) == ("flat", "none") and needs_training(*target)
+        if self.index.d == self.index_dim and ((self.kind, self.sq) == target or pending):
+            self._maybe_train()
+            return
+        lossless = self.full is not None and self.full.read(list(self.db.live_ids())[:1]) is not None
+        if not lossless and (self.kind == "ivf_pq" or self.index.d < self.index_dim):
+            logging.warning("[KB] index is %s/%s dim=%d, cannot convert to %s/%s dim=%d without re-embedding "
+                            "(rebuild it from the embedding cache)", self.kind, self.sq, self.index.d,
+                            self.index_type, self.quantization, self.index_dim)
+            self.index_dim = self.index.d
+            return
+        logging.info("[KB] converting index %s/%s dim=%d -> %s/%s dim=%d", self.kind, self.sq, self.index.d,
+                     self.index_type, self.quantization, self.index_dim)
+        if needs_training(*target) and self.ntotal < self.min_train:
+            self._rebuild("flat", "none")
+        else:
+            self._rebuild(*target)
@@ -1,15 +1,63 @@
 import hashlib
-from typing import Iterator, Tuple
+import logging
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Tuple
+import httpx
 import requests
 from xml.etree import ElementTree as ET
-from urllib.parse import quote
+from urllib.parse import quote, unquote, urlsplit
+
+# Запрашиваем только нужные свойства, чтобы ответ PROPFIND был как можно меньше
+PROPFIND_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:"><d:prop>'
+    '<d:resourcetype/><d:getcontentlength/><d:getetag/><d:getlastmodified/>'
+    '</d:prop></d:propfind>'
+)
+
+_DAV = "{DAV:}"
+
+
+class RemoteFile(NamedTuple):
+    path: str
+    size: int
+    etag: Optional[str] = None
+    modified: Optional[str] = None
+
+    @property
+    def signature(self) -> str:
+        """Подпись версии файла без скачивания: etag (md5 у Я.Диска) или size+mtime."""
+        if self.etag:
+            return self.etag
+        return f"{self.size}:{self.modified or ''}"
+
 
 class YandexDiskClient:
     """Минималистичный WebDAV клиент для Яндекс.Диска."""
-    def __init__(self, token: str, base_url: str = "https://webdav.yandex.ru"):
+    def __init__(self, token: str, base_url: str = "https://webdav.yandex.ru", max_connections: int = 8):
         self.base_url = base_url.rstrip("/")
         self.session = requests.Session()
         self.session.headers.update({"Authorization": f"OAuth {token}"})
+        self.max_connections = max_connections
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """Общий keep-alive пул для асинхронных скачиваний (создаётся лениво)."""
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(
+                headers=dict(self.session.headers),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                follow_redirects=True,
+            )
+        return self._async_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
 
     def _full(self, path: str) -> str:
         if path.startswith("disk:"):
@@ -19,24 +67,67 @@ class YandexDiskClient:
         path = quote(path, safe="/")
         return f"{self.base_url}{path}"
 
-    def iter_files(self, root_path: str) -> Iterator[Tuple[str, int]]:
-        url = self._full(root_path)
-        resp = self.session.request("PROPFIND", url, headers={"Depth": "infinity"})
-        if resp.status_code == 401:
-            raise RuntimeError(f"401 Unauthorized. Body: {resp.text}")
-        resp.raise_for_status()
-        ns = {'d': 'DAV:'}
-        root = ET.fromstring(resp.text)
-        for r in root.findall('d:response', ns):
-            href_el = r.find('d:href', ns)
-            if href_el is None:
-                continue
-            href = href_el.text
-            if href.endswith('/'):
-                continue
-            size_el = r.find('.//d:getcontentlength', ns)
-            size = int(size_el.text) if size_el is not None else 0
-            yield href, size
+    def _propfind(self, path: str, depth: str, timeout: float) -> Iterator[Tuple[str, bool, RemoteFile]]:
+        """
+        (href, is_dir, file) по мере чтения ответа: тело разбирается iterparse из потока,
+        обработанные <d:response> сразу удаляются, поэтому память не растёт с размером дерева.
+        """
+        resp = self.session.request(
+            "PROPFIND", self._full(path),
+            headers={"Depth": depth, "Content-Type": "application/xml"},
+            data=PROPFIND_BODY.encode("utf-8"),
+            stream=True, timeout=timeout,
+        )
+        with resp:
+            if resp.status_code == 401:
+                raise RuntimeError(f"401 Unauthorized. Body: {resp.text}")
+            resp.raise_for_status()
+            resp.raw.decode_content = True  # gzip/deflate распаковываются на лету
+            events = ET.iterparse(resp.raw, events=("start", "end"))
+            _, root = next(events)
+            for event, el in events:
+                if event != "end" or el.tag != _DAV + "response":
+                    continue
+                href = urlsplit(el.findtext(_DAV + "href") or "").path
+                if href:
+                    is_dir = href.endswith("/") or el.find(f".//{_DAV}resourcetype/{_DAV}collection") is not None
+                    size = el.findtext(f".//{_DAV}getcontentlength")
+                    etag = el.findtext(f".//{_DAV}getetag")
+                    yield href, is_dir, RemoteFile(
+                        path=unquote(href),
+                        size=int(size) if size else 0,
+                        etag=etag.strip('"') if etag else None,
+                        modified=el.findtext(f".//{_DAV}getlastmodified"),
+                    )
+                # root держит ссылки на все разобранные ответы — освобождаем их
+                root.clear()
+
+    def iter_files(self, root_path: str, timeout: float = 300.0) -> Iterator[RemoteFile]:
+        """
+        Все файлы под root_path одним PROPFIND Depth: infinity, разбираемым потоком.
+        Если сервер не поддерживает бесконечную глубину (403/400), обходит дерево
+        запросами Depth: 1 по папкам; в памяти — только очередь ещё не открытых папок.
+        """
+        try:
+            for _, is_dir, rf in self._propfind(root_path, "infinity", timeout):
+                if not is_dir:
+                    yield rf
+            return
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in (400, 403):
+                raise
+            logging.info("[KB] Depth: infinity rejected (%s), listing %s folder by folder",
+                         e.response.status_code, root_path)
+        folders = [root_path]
+        while folders:
+            folder = folders.pop()
+            own = unquote(self._full(folder)[len(self.base_url):]).rstrip("/")
+            for href, is_dir, rf in self._propfind(folder, "1", timeout):
+                if not is_dir:
+                    yield rf
+                elif unquote(href).rstrip("/") != own:
+                    # первая запись ответа — сама папка
+                    folders.append(unquote(href))
 
     def download(self, remote_path: str) -> bytes:
         url = self._full(remote_path)
@@ -46,6 +137,35 @@ class YandexDiskClient:
         r.raise_for_status()
         return r.content
 
+    async def adownload_to(self, remote_path: str, out: BinaryIO, timeout: Optional[float] = None) -> int:
+        """
+        Дописывает файл в out потоком; если в out уже есть начало (прошлая попытка
+        оборвалась), запрашивает остаток через Range. Возвращает итоговый размер.
+        """
+        url = self._full(remote_path)
+        offset = out.tell()
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+        async with self.async_client.stream("GET", url, headers=headers, timeout=timeout) as r:
+            if r.status_code == 401:
+                await r.aread()
+                raise RuntimeError(f"401 Unauthorized. Body: {r.text}")
+            if r.status_code == 416 and offset:
+                return offset  # всё уже скачано
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                # сервер проигнорировал Range — начинаем заново
+                out.seek(0)
+                out.truncate()
+            # без chunk_size: части пишутся сразу, и при обрыве докачка начнётся с них
+            async for part in r.aiter_bytes():
+                out.write(part)
+        return out.tell()
+
+    def iter_contents(self, files, concurrency: int = 4, timeout: float = 120.0, retries: int = 3):
+        """Реализация DocumentSource: параллельное скачивание с повторами и докачкой."""
+        from .downloader import iter_downloads  # downloader сам импортирует этот модуль
+        return iter_downloads(self, files, concurrency=concurrency, timeout=timeout, retries=retries)
+
     @staticmethod
     def file_signature(content: bytes) -> str:
         return hashlib.md5(content).hexdigest()
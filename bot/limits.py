@@ -19,3 +19,6 @@ STREAM_TIMEOUT_GROUP = [180, 120, 90, 50]  # зависит от длины
 STREAM_TIMEOUT_PRIVATE = [90, 45, 25, 15]
 
 MAX_CONTEXT_TOKENS = 12000
+
+# 📎 Сколько символов извлечённого текста документа отправлять в модель
+MAX_DOC_PROMPT_CHARS = 20000
@@ -8,6 +8,19 @@ from telegram.ext import ApplicationBuilder
 from bot.telegram_bot import ChatGPTTelegramBot
 from bot.openai_helper import OpenAIHelper
 from bot.plugin_manager import PluginManager
+from bot.knowledge_base.embedder import Embedder
+from bot.knowledge_base.embedding_cache import CachedEmbedder, EmbeddingCache
+from bot.knowledge_base.listing_cache import ListingCache
+from bot.knowledge_base.local_embedder import LocalEmbedder
+from bot.knowledge_base.parser_pool import ParsePool
+from bot.knowledge_base.reindex_job import ReindexJob
+from bot.knowledge_base.reindexer import INDEX_STATE
+from bot.knowledge_base.retriever import Retriever
+from bot.knowledge_base.snapshots import IndexSnapshots
+from bot.knowledge_base.sources import LocalSource
+from bot.knowledge_base.splitter import warm_up as warm_up_tokenizers
+from bot.knowledge_base.vector_store import VectorStore
+from bot.knowledge_base.yandex_client import YandexDiskClient
 
 try:
     from bot.error_tracer import init_error_tracer
@@ -31,6 +44,7 @@ async def _post_init(application, bot: ChatGPTTelegramBot, enable_image: bool, e
         BotCommand("help", "помощь"),
         BotCommand("reset", "сброс диалога"),
         BotCommand("kb", "база знаний / поиск"),
+        BotCommand("reindex", "переиндексировать базу знаний"),
         BotCommand("pdfpass", "ввести пароль к PDF"),
         BotCommand("list_models", "показать модели"),
         BotCommand("set_model", "выбрать модель"),
@@ -80,6 +94,8 @@ def main():
         "enable_image_generation": os.environ.get("ENABLE_IMAGE_GENERATION", "true").lower() == "true",
         "enable_tts_generation": os.environ.get("ENABLE_TTS_GENERATION", "false").lower() == "true",
         "functions_max_consecutive_calls": int(os.environ.get("FUNCTIONS_MAX_CONSECUTIVE_CALLS", "3")),
+        # бюджет токенов фрагментов базы знаний в промпте; 0 = не подмешивать
+        "kb_context_tokens": int(os.environ.get("KB_CONTEXT_TOKENS", "3000")),
     }
 
     plugin_config = {}
@@ -89,19 +105,122 @@ def main():
         "enable_image_generation": openai_config["enable_image_generation"],
         "enable_tts_generation": openai_config["enable_tts_generation"],
         "allowed_models": os.environ.get("ALLOWED_MODELS", "").split(",") if os.environ.get("ALLOWED_MODELS") else None,
+        "admin_user_ids": os.environ.get("ADMIN_USER_IDS", "-"),
+        "kb_reindex_interval": float(os.environ.get("KB_REINDEX_INTERVAL_HOURS", "0")) * 3600,  # 0 = только /reindex
+        # опрос локального каталога (KB_LOCAL_DIR), секунд; 0 = не следить
+        "kb_watch_interval": float(os.environ.get("KB_WATCH_INTERVAL", "2")) if os.environ.get("KB_LOCAL_DIR") else 0,
     }
 
+    kb_config = {
+        "parse_workers": int(os.environ.get("KB_PARSE_WORKERS", "0")) or None,  # 0 = по числу ядер
+        "parse_cpu_timeout": float(os.environ.get("KB_PARSE_CPU_TIMEOUT", "60")),
+        "parse_timeout": float(os.environ.get("KB_PARSE_TIMEOUT", "120")),
+        "root_path": os.environ.get("YANDEX_ROOT_PATH", "/knowledge_base"),
+        "local_dir": os.environ.get("KB_LOCAL_DIR", ""),  # если задан — документы берутся отсюда, а не с Я.Диска
+        "webdav_url": os.environ.get("YANDEX_DISK_WEBDAV_URL", "https://webdav.yandex.ru"),
+        "yandex_token": os.environ.get("YANDEX_DISK_TOKEN", "").strip(),
+        "embedder": os.environ.get("KB_EMBEDDER", "openai"),  # openai | local (офлайн, без API)
+        "embedding_model": os.environ.get("KB_EMBEDDING_MODEL", "text-embedding-3-large"),
+        "embedding_dim": int(os.environ.get("KB_EMBEDDING_DIM", "3072")),
+        "local_embedding_dim": int(os.environ.get("KB_LOCAL_EMBEDDING_DIM", "512")),
+        "embedding_cache": os.environ.get("KB_EMBEDDING_CACHE", "data/embeddings.sqlite"),
+        # снимки индекса; у локальных эмбеддингов — свой каталог, векторы разных моделей несовместимы
+        "index_dir": os.environ.get("KB_INDEX_DIR", "data/kb-local" if os.environ.get("KB_EMBEDDER") == "local"
+                                    else "data/kb"),
+        "index_path": os.environ.get("KB_INDEX_PATH", "data/index.faiss"),  # старый формат, переносится в index_dir
+        "index_type": os.environ.get("KB_INDEX_TYPE", "flat"),
+        "quantization": os.environ.get("KB_QUANTIZATION", "none"),  # none | fp16 | int8
+        "truncate_dim": int(os.environ.get("KB_TRUNCATE_DIM", "0")) or None,  # 0 = полная размерность
+        "rescore": int(os.environ.get("KB_RESCORE", "0")),  # кандидатов на k для точного пересчёта; 0 = выкл
+        "search_mode": os.environ.get("KB_SEARCH_MODE", "hybrid"),
+        "listing_ttl": float(os.environ.get("KB_LISTING_TTL", "300")),
+    }
+
+    # файлы BPE tiktoken кэшируются рядом с индексом: после первой загрузки сеть не нужна
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.abspath("data/tiktoken"))
+    try:
+        # токенизаторы загружаем при старте, а не на первом сообщении
+        warm_up_tokenizers([openai_config["model"], "gpt-4o-mini"])
+    except Exception as e:
+        logging.warning("Tokenizer warm-up failed: %s", e)
+
     plugin_manager = PluginManager(config=plugin_config)
     openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
-    bot = ChatGPTTelegramBot(config=telegram_config, openai_helper=openai_helper)
+    parse_pool = ParsePool(
+        workers=kb_config["parse_workers"],
+        cpu_timeout=kb_config["parse_cpu_timeout"],
+        timeout=kb_config["parse_timeout"],
+    )
+
+    # ------- База знаний -------
+    if kb_config["embedder"] == "local":
+        # считается быстрее, чем читается из кэша — без CachedEmbedder
+        embedder = LocalEmbedder(dim=kb_config["local_embedding_dim"])
+        embedding_dim = embedder.dim
+    else:
+        embedder = CachedEmbedder(
+            Embedder(api_key=openai_config["api_key"], model=kb_config["embedding_model"]),
+            EmbeddingCache(kb_config["embedding_cache"]),
+        )
+        embedding_dim = kb_config["embedding_dim"]
+
+    def open_store(path: str, read_only: bool = False) -> VectorStore:
+        return VectorStore(embedding_dim, path=path, index_type=kb_config["index_type"],
+                           quantization=kb_config["quantization"], truncate_dim=kb_config["truncate_dim"],
+                           rescore=kb_config["rescore"], read_only=read_only)
+
+    # старый однофайловый индекс построен эмбеддингами OpenAI — в локальный каталог не переносим
+    legacy = kb_config["embedder"] != "local"
+    snapshots = IndexSnapshots(kb_config["index_dir"], open_store,
+                               legacy_index=kb_config["index_path"] if legacy else None,
+                               legacy_state=INDEX_STATE if legacy else None)
+    retriever = Retriever(embedder, snapshots, mode=kb_config["search_mode"])
+    openai_helper.set_retriever(retriever)
+
+    reindex_job = None
+    kb_listing = None
+    token = kb_config["yandex_token"]
+    if token.lower().startswith("oauth "):
+        token = token.split(None, 1)[1].strip()
+    # один источник на всё время работы: /kb и переиндексация делят пул соединений
+    kb_source, root_path = None, kb_config["root_path"]
+    if kb_config["local_dir"]:
+        kb_source, root_path = LocalSource(), kb_config["local_dir"]
+    elif token:
+        kb_source = YandexDiskClient(token=token, base_url=kb_config["webdav_url"])
+    if kb_source is not None:
+        kb_listing = ListingCache(kb_source, root_path, ttl=kb_config["listing_ttl"])
+        reindex_job = ReindexJob(
+            root_path=root_path,
+            source=kb_source,
+            snapshots=snapshots,
+            embedder=embedder,
+            parser=parse_pool,
+            listing=kb_listing,
+        )
+
+    bot = ChatGPTTelegramBot(config=telegram_config, openai_helper=openai_helper, retriever=retriever,
+                             parse_pool=parse_pool, reindex_job=reindex_job, kb_listing=kb_listing)
 
     async def post_init(application):
         await _post_init(application, bot, telegram_config["enable_image_generation"], telegram_config["enable_tts_generation"])
 
+    async def post_shutdown(application):
+        if reindex_job is not None:
+            reindex_job.cancel()
+        if kb_listing is not None:
+            await kb_listing.aclose()
+        if kb_source is not None:
+            await kb_source.aclose()
+        retriever.close()
+        snapshots.close()
+        parse_pool.shutdown()
+
     application = (
         ApplicationBuilder()
         .token(telegram_config["token"])
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
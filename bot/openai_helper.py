@@ -232,9 +232,12 @@ class OpenAIHelper:
 
             self.__add_to_history(chat_id, role="user", content=query)
 
+            # Knowledge base fragments are added to the request only, not to the history
+            kb_budget = self.config.get('kb_context_tokens', 0) if self.retriever is not None else 0
+
             # Summarize the chat history if it's too long to avoid excessive token usage
             token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
+            exceeded_max_tokens = token_count + kb_budget + self.config['max_tokens'] > self.__max_model_tokens()
             exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
 
             if exceeded_max_tokens or exceeded_max_history_size:
@@ -252,9 +255,12 @@ class OpenAIHelper:
             user_model = self.user_models.get(chat_id, self.config['model'])
             model_to_use = user_model if not self.conversations_vision[chat_id] else self.config['vision_model']
             max_tokens_str = 'max_completion_tokens' if self.config['model'] in O_MODELS else 'max_tokens'
+            messages = self.conversations[chat_id]
+            if kb_budget:
+                messages = await self.__with_kb_context(messages, query, kb_budget)
             common_args = {
                 'model': model_to_use,
-                'messages': self.conversations[chat_id],
+                'messages': messages,
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 max_tokens_str: self.config['max_tokens'],
@@ -279,6 +285,21 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
+    async def __with_kb_context(self, messages: list, query: str, token_budget: int) -> list:
+        """
+        Inserts knowledge base fragments for the query before the last user message.
+        :param messages: The conversation history, the query is the last message
+        :param query: The user query
+        :param token_budget: Maximum number of tokens of the fragments
+        :return: A new list of messages; the history itself is not changed
+        """
+        try:
+            chunks = await self.retriever.acontext(query, token_budget=token_budget)
+        except Exception as e:
+            logging.warning(f'Knowledge base search failed: {str(e)}')
+            return messages
+        return messages[:-1] + build_context_messages(chunks) + messages[-1:]
+
     async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
         function_name = ''
         arguments = ''
@@ -423,9 +444,12 @@ class OpenAIHelper:
                         break
                 self.__add_to_history(chat_id, role="user", content=query)
 
+            # Knowledge base fragments are added to the request only, not to the history
+            kb_budget = self.config.get('kb_context_tokens', 0) if self.retriever is not None else 0
+
             # Summarize the chat history if it's too long to avoid excessive token usage
             token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
+            exceeded_max_tokens = token_count + kb_budget + self.config['max_tokens'] > self.__max_model_tokens()
             exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
 
             if exceeded_max_tokens or exceeded_max_history_size:
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
 from typing import Optional, List
@@ -23,9 +24,14 @@ from telegram.ext import (
 
 from bot.openai_helper import OpenAIHelper, GPT_ALL_MODELS
 from bot.usage_tracker import UsageTracker  # можно не использовать
+from bot.limits import MAX_DOC_PROMPT_CHARS
+from bot.utils import is_admin
 
 # База знаний
-from bot.knowledge_base.yandex_client import YandexDiskClient
+from bot.knowledge_base.listing_cache import ListingCache, TokenRejected
+from bot.knowledge_base.loaders import EXT_LOADERS, PasswordRequired, load_document
+from bot.knowledge_base.parser_pool import ParsePool
+from bot.knowledge_base.reindex_job import ReindexBusy, ReindexJob
 from bot.knowledge_base.passwords import (
     set_awaiting_password,
     get_awaiting_password_file,
@@ -49,11 +55,17 @@ class ChatGPTTelegramBot:
         openai_helper: OpenAIHelper,
         usage_tracker: Optional[UsageTracker] = None,
         retriever=None,
+        parse_pool: Optional[ParsePool] = None,
+        reindex_job: Optional[ReindexJob] = None,
+        kb_listing: Optional[ListingCache] = None,
     ):
         self.config = config
         self.openai = openai_helper
         self.usage_tracker = usage_tracker
         self.retriever = retriever
+        self.parse_pool = parse_pool
+        self.reindex_job = reindex_job
+        self.kb_listing = kb_listing
 
     # ------------------------------------------------------------------
     # Регистрация хендлеров
@@ -65,6 +77,7 @@ class ChatGPTTelegramBot:
         application.add_handler(CommandHandler("reset", self.reset))
 
         application.add_handler(CommandHandler("kb", self.show_knowledge_base))
+        application.add_handler(CommandHandler("reindex", self.reindex_command))
         application.add_handler(CommandHandler("pdfpass", self.pdf_pass_command))
 
         application.add_handler(CommandHandler("list_models", self.list_models))
@@ -115,6 +128,7 @@ class ChatGPTTelegramBot:
             "/start, /help — помощь\n"
             "/reset — сброс диалога\n"
             "/kb [запрос] — показать файлы или поиск в БЗ\n"
+            "/reindex [cancel] — переиндексировать БЗ (только админ)\n"
             "/pdfpass <file.pdf> <password> — ввести пароль к PDF\n"
             "/list_models — показать доступные модели\n"
             "/set_model <name> — выбрать модель для этого чата\n"
@@ -198,37 +212,17 @@ class ChatGPTTelegramBot:
     async def show_knowledge_base(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.warning(">>> Команда /kb вызвана")
         try:
-            kb_root = os.getenv("YANDEX_ROOT_PATH", "/knowledge_base")
-            if kb_root.startswith("disk:"):
-                kb_root = kb_root[5:]
-            if not kb_root.startswith("/"):
-                kb_root = "/" + kb_root
-
-            base_url_raw = os.getenv("YANDEX_DISK_WEBDAV_URL", "https://webdav.yandex.ru")
-            base_url = base_url_raw.rstrip("/")
-
-            token_raw = os.getenv("YANDEX_DISK_TOKEN", "").strip()
-            token = token_raw.split(None, 1)[1].strip() if token_raw.lower().startswith("oauth ") else token_raw
-
-            if not token:
-                await update.message.reply_text("Не задан YANDEX_DISK_TOKEN")
-                return
-
-            logging.debug(
-                "YD base_url=%s, root=%s, token_len=%d, token_has_oauth_prefix=%s",
-                base_url, kb_root, len(token), token_raw.lower().startswith("oauth ")
-            )
-
             # /kb <query> — поиск
             text = (update.message.text or "")
             query = text.partition(" ")[2].strip()
             if query and getattr(self, "retriever", None):
                 try:
-                    results = self.retriever.search(query, top_k=5)
+                    # те же фрагменты, что уходят в промпт: соседние чанки склеены, повторы отсеяны MMR
+                    results = await self.retriever.acontext(query, token_budget=1000)
                     if not results:
                         await update.message.reply_text("Ничего не найдено.")
                         return
-                    reply = "Найдено:\n\n" + "\n\n---\n\n".join(results[:5])
+                    reply = "Найдено:\n\n" + "\n\n---\n\n".join(results)
                     await update.message.reply_text(reply[:4000])
                     return
                 except Exception as e:
@@ -237,31 +231,12 @@ class ChatGPTTelegramBot:
                     await update.message.reply_text("Ошибка поиска в базе знаний.")
                     return
 
-            # REST preflight
-            try:
-                r = requests.get(
-                    "https://cloud-api.yandex.net/v1/disk",
-                    headers={"Authorization": f"OAuth {token}"},
-                    timeout=10,
-                )
-                if r.status_code == 401:
-                    logging.error("REST check failed: 401, body=%s", r.text)
-                    await update.message.reply_text(
-                        "Токен Я.Диска отвергнут (REST 401). Проверь YANDEX_DISK_TOKEN (без 'OAuth ')."
-                    )
-                    return
-                elif r.status_code >= 400:
-                    logging.error("REST check failed: %s, body=%s", r.status_code, r.text)
-                    await update.message.reply_text(f"REST check error {r.status_code}: {r.text[:200]}")
-                    return
-            except requests.exceptions.RequestException as e:
-                capture_exception(e)
-                logging.error("REST check network error: %s", e, exc_info=True)
-                await update.message.reply_text("Не удалось проверить токен через REST API Я.Диска. Проверь сеть.")
+            if self.kb_listing is None:
+                await update.message.reply_text("Не задан YANDEX_DISK_TOKEN или KB_LOCAL_DIR")
                 return
 
-            yd = YandexDiskClient(token=token, base_url=base_url)
-            files = [path for path, _ in yd.iter_files(kb_root)]
+            # список из кэша; сеть нужна только при первом обращении
+            files = await self.kb_listing.get()
 
             if not files:
                 await update.message.reply_text("В базе знаний нет файлов.")
@@ -273,6 +248,11 @@ class ChatGPTTelegramBot:
 
             await update.message.reply_text(reply)
 
+        except TokenRejected as e:
+            logging.error("REST check failed: %s", e)
+            await update.message.reply_text(
+                "Токен Я.Диска отвергнут (REST 401). Проверь YANDEX_DISK_TOKEN (без 'OAuth ')."
+            )
         except requests.exceptions.RequestException as e:
             capture_exception(e)
             logging.error("Сетевой сбой при обращении к Я.Диску: %s", e, exc_info=True)
@@ -282,6 +262,49 @@ class ChatGPTTelegramBot:
             logging.error("Ошибка при получении списка файлов из базы знаний", exc_info=True)
             await update.message.reply_text("Не удалось загрузить базу знаний. Проверь токен или путь")
 
+    async def reindex_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not is_admin(self.config, update.effective_user.id):
+            await update.message.reply_text("Команда доступна только администратору.")
+            return
+        if self.reindex_job is None:
+            await update.message.reply_text("Индексация не настроена (нет YANDEX_DISK_TOKEN или KB_LOCAL_DIR).")
+            return
+
+        arg = (update.message.text or "").partition(" ")[2].strip().lower()
+        if arg in ("cancel", "stop"):
+            if self.reindex_job.cancel():
+                await update.message.reply_text("Индексация отменяется…")
+            else:
+                await update.message.reply_text("Индексация не запущена.")
+            return
+        if self.reindex_job.running:
+            await update.message.reply_text("Индексация уже идёт. /reindex cancel — отменить.")
+            return
+
+        message = await update.message.reply_text("Индексация запущена…")
+        if context.job_queue is not None:
+            context.job_queue.run_once(self.reindex_job_callback, 0, data=message, name="kb-reindex")
+        else:
+            context.application.create_task(self._run_reindex(message))
+
+    async def reindex_job_callback(self, context: ContextTypes.DEFAULT_TYPE):
+        """Запуск из JobQueue: по расписанию (data=None) или из /reindex (data — сообщение для прогресса)."""
+        await self._run_reindex(context.job.data)
+
+    async def _run_reindex(self, message=None):
+        report = message.edit_text if message is not None else None
+        try:
+            await self.reindex_job.run(report)
+        except ReindexBusy:
+            logging.info("[KB] reindex is already running, skipping")
+            if message is not None:
+                await message.edit_text("Индексация уже идёт.")
+        except asyncio.CancelledError:
+            logging.info("[KB] reindex cancelled")
+        except Exception as e:
+            capture_exception(e)
+            logging.error("Reindex failed", exc_info=True)
+
     async def handle_kb_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Заглушка для inline-кнопок KB, чтобы не было AttributeError."""
         try:
@@ -314,13 +337,33 @@ class ChatGPTTelegramBot:
     async def handle_file_upload(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             doc = update.message.document
+            filename = doc.file_name or "document"
+            if os.path.splitext(filename)[1].lower() not in EXT_LOADERS:
+                await update.message.reply_text(f"Формат файла {filename} не поддерживается.")
+                return
             file = await doc.get_file()
-            file_bytes = await file.download_as_bytearray()
+            file_bytes = bytes(await file.download_as_bytearray())
+
+            # разбор тяжёлых форматов — в пуле процессов, чтобы не блокировать event loop
+            password = get_pdf_password(filename)
+            if self.parse_pool is not None:
+                text = await self.parse_pool.parse(filename, file_bytes, password)
+            else:
+                text = await asyncio.to_thread(load_document, filename, file_bytes, password)
 
-            text = f"Документ {doc.file_name} ({doc.file_size} bytes) получен. (Тут сделай извлечение текста)"
+            if not text.strip():
+                await update.message.reply_text(f"Не удалось извлечь текст из {filename}.")
+                return
             chat_id = update.effective_chat.id
-            answer, _ = await self.openai.get_chat_response(chat_id, f"Проанализируй документ:\n{text}")
+            answer, _ = await self.openai.get_chat_response(
+                chat_id, f"Проанализируй документ {filename}:\n{text[:MAX_DOC_PROMPT_CHARS]}"
+            )
             await update.message.reply_text(answer[:4000])
+        except PasswordRequired:
+            set_awaiting_password(update.effective_chat.id, doc.file_name)
+            await update.message.reply_text(
+                f"Файл {doc.file_name} защищён паролем. Используй /pdfpass {doc.file_name} <пароль> и пришли файл снова."
+            )
         except Exception as e:
             capture_exception(e)
             await update.message.reply_text(f"Ошибка при анализе документа: {e}")
@@ -387,4 +430,13 @@ class ChatGPTTelegramBot:
         logging.error("Exception while handling an update:", exc_info=context.error)
 
     async def post_init(self, application: Application):
-        pass
+        if self.reindex_job is not None and self.config.get("kb_watch_interval"):
+            # локальный каталог: индексируем изменения через несколько секунд после записи
+            application.create_task(self.reindex_job.watch(self.config["kb_watch_interval"]))
+        interval = self.config.get("kb_reindex_interval", 0)
+        if self.reindex_job is None or not interval:
+            return
+        if application.job_queue is None:
+            logging.warning("JobQueue unavailable (install python-telegram-bot[job-queue]), scheduled reindex disabled")
+            return
+        application.job_queue.run_repeating(self.reindex_job_callback, interval=interval, first=60, name="kb-reindex")